@@ -686,50 +686,269 @@ from langchain_core.messages import HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 import os
+import sys
+import numpy as np
 import torch
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
-import matplotlib.pyplot as plt
+from diffusers import StableDiffusionPipeline, StableDiffusionImg2ImgPipeline, DPMSolverMultistepScheduler
+from diffusers import AutoencoderKL, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
 import re
 import random
-from datetime import datetime
+import hashlib
+import json
+import queue
+import threading
+import time
+import argparse
+import asyncio
+import gc
+import glob
+import itertools
+import math
+import resource
+import shutil
+import signal
+import sqlite3
+import subprocess
+import tempfile
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Single-flight coalescing: concurrent callers with the same key share one in-flight call
+_inflight_calls = {}
+_inflight_lock = threading.Lock()
+
+def single_flight(key, fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) once for all concurrent callers using the same key.
+    The first caller does the work; the others wait on its future and receive
+    the same result (or exception). Nothing is cached once the call finishes.
+    """
+    with _inflight_lock:
+        future = _inflight_calls.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _inflight_calls[key] = future
+    
+    if not is_leader:
+        print(f"Joining in-flight call for {key[0]}")
+        return future.result()
+    
+    try:
+        result = fn(*args, **kwargs)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight_calls.pop(key, None)
+
+# Retry policy for upstream model calls: exponential backoff, jitter, Retry-After and a shared budget
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '4'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '20'))
+
+class UpstreamError(Exception):
+    """An upstream HTTP error carrying its status code and Retry-After delay, if any."""
+    def __init__(self, message: str, status_code: int | None = None, retry_after: float | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class RetryBudget:
+    """
+    Token bucket shared by all upstream calls. Every call deposits `ratio` tokens and
+    every retry spends one, so retries stay a bounded fraction of traffic and an
+    outage can't turn into a retry storm.
+    """
+    def __init__(self, ratio: float = 0.2, initial_tokens: float = 10, max_tokens: float = 100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = initial_tokens
+        self._lock = threading.Lock()
+    
+    def record_call(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+    
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+retry_budget = RetryBudget(ratio=float(os.getenv('RETRY_BUDGET_RATIO', '0.2')))
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header given either as seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+# ChatNVIDIA errors carry no headers, so a response hook on its sessions (see get_chat_model)
+# records the Retry-After of the last retryable response seen by each thread
+_upstream_responses = threading.local()
+
+def record_retry_after(response, *args, **kwargs):
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        _upstream_responses.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+    else:
+        _upstream_responses.retry_after = None
+
+def classify_upstream_error(error: Exception) -> tuple[bool, float | None]:
+    """
+    Decide whether an error from requests or ChatNVIDIA is transient.
+    Returns (retryable, retry_after_seconds).
+    """
+    if isinstance(error, UpstreamError):
+        return error.status_code in RETRYABLE_STATUS_CODES, error.retry_after
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True, None
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'status_code', None):
+        return response.status_code in RETRYABLE_STATUS_CODES, parse_retry_after(response.headers.get('Retry-After'))
+    # ChatNVIDIA raises a plain Exception whose message starts with "[<status>] <title>"
+    match = re.match(r'^\[(\d{3})\]', str(error))
+    if match:
+        return int(match.group(1)) in RETRYABLE_STATUS_CODES, getattr(_upstream_responses, 'retry_after', None)
+    return False, None
+
+def call_with_retry(fn, *args, **kwargs):
+    """
+    Call fn(*args, **kwargs), retrying transient upstream errors (429/5xx, connection
+    errors) with exponential backoff and full jitter. A Retry-After hint is honored
+    unless it exceeds RETRY_MAX_DELAY; retries stop when the shared budget is empty.
+    """
+    retry_budget.record_call()
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            retryable, retry_after = classify_upstream_error(e)
+            if not retryable or attempt == RETRY_MAX_ATTEMPTS:
+                raise
+            if retry_after is not None and retry_after > RETRY_MAX_DELAY:
+                print(f"Upstream asked to retry after {retry_after:.0f}s, giving up")
+                raise
+            if not retry_budget.try_spend():
+                print("Retry budget exhausted, not retrying")
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            print(f"Transient upstream error ({str(e).splitlines()[0][:80]}), "
+                  f"retrying in {delay:.2f}s (attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS})")
+            time.sleep(delay)
+
+def post_with_retry(url: str, payload: dict, **kwargs) -> requests.Response:
+    """requests.post under call_with_retry; retryable status codes raise UpstreamError."""
+    def _post():
+        response = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, **kwargs)
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise UpstreamError(f"{response.status_code} - {response.text[:200]}", response.status_code,
+                                parse_retry_after(response.headers.get('Retry-After')))
+        return response
+    return call_with_retry(_post)
+
+# LLM clients are kept warm too: constructing ChatNVIDIA may query the server's model list
+_chat_models = {}
+_chat_models_lock = threading.Lock()
+
+def get_chat_model(model: str, max_tokens: int, temperature: float) -> ChatNVIDIA:
+    """Return a cached ChatNVIDIA client for this model and settings."""
+    base_url = os.getenv('NVIDIA_BASE_URL', 'http://0.0.0.0:9004/v1')
+    key = (model, base_url, max_tokens, temperature)
+    with _chat_models_lock:
+        if key not in _chat_models:
+            llm = ChatNVIDIA(model=model, base_url=base_url, max_tokens=max_tokens, temperature=temperature)
+            # Retry-After is only visible through the client's private session factory; if the
+            # library changes it, retries fall back to plain exponential backoff
+            try:
+                make_session = llm._client.get_session_fn
+                if not callable(make_session):
+                    raise AttributeError("get_session_fn is not callable")
+                def session_with_hook():
+                    session = make_session()
+                    hooks = getattr(session, "hooks", None)
+                    if isinstance(hooks, dict):
+                        hooks.setdefault("response", []).append(record_retry_after)
+                    return session
+                llm._client.get_session_fn = session_with_hook
+            except AttributeError as e:
+                print(f"Retry-After headers unavailable for {model}, using plain backoff: {str(e)}")
+            _chat_models[key] = llm
+        return _chat_models[key]
 
 # Task 1: Image Ingestion
 def ask_about_image(image_path: str, question: str = "Describe the image") -> str:
     """
     Analyze an image using a vision-language model and return a description.
+    Concurrent calls for the same image content and question share one upstream request.
     """
     try:
-        # Read and encode the image
         with open(image_path, "rb") as image_file:
             image_data = image_file.read()
-        
-        image_format = image_path.split('.')[-1].lower()
-        if image_format == 'jpg':
-            image_format = 'jpeg'
-        
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return f"Unable to process {image_path}."
+    
+    key = ("describe", hashlib.sha256(image_data).hexdigest(), question)
+    return single_flight(key, _describe_image, image_path, image_data, question)
+
+def encode_image_for_vlm(image_path: str, image_data: bytes) -> tuple[str, str]:
+    """
+    Base64-encode image bytes for a VLM request, downsizing images over the payload limit.
+    Returns (image_b64, image_format).
+    """
+    image_format = image_path.split('.')[-1].lower()
+    if image_format == 'jpg':
+        image_format = 'jpeg'
+    
+    image_b64 = base64.b64encode(image_data).decode('utf-8')
+    print(f"Original image base64 length: {len(image_b64)}")
+    
+    # Resize if base64 exceeds limit
+    max_b64_length = 200000  # Slightly below 204,800 for safety
+    if len(image_b64) > max_b64_length:
+        print(f"Image too large, resizing...")
+        img = Image.open(image_path)
+        width, height = img.size
+        max_dim = 512
+        if width > height:
+            new_width = max_dim
+            new_height = int(height * max_dim / width)
+        else:
+            new_height = max_dim
+            new_width = int(width * max_dim / height)
+        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        image_data = buffer.getvalue()
         image_b64 = base64.b64encode(image_data).decode('utf-8')
-        print(f"Original image base64 length: {len(image_b64)}")
-        
-        # Resize if base64 exceeds limit
-        max_b64_length = 200000  # Slightly below 204,800 for safety
-        if len(image_b64) > max_b64_length:
-            print(f"Image too large, resizing...")
-            img = Image.open(image_path)
-            width, height = img.size
-            max_dim = 512
-            if width > height:
-                new_width = max_dim
-                new_height = int(height * max_dim / width)
-            else:
-                new_height = max_dim
-                new_width = int(width * max_dim / height)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            buffer = io.BytesIO()
-            img.save(buffer, format="PNG")
-            image_data = buffer.getvalue()
-            image_b64 = base64.b64encode(image_data).decode('utf-8')
-            print(f"Resized image base64 length: {len(image_b64)}")
-            image_format = "png"
+        print(f"Resized image base64 length: {len(image_b64)}")
+        image_format = "png"
+    return image_b64, image_format
+
+def _describe_image(image_path: str, image_data: bytes, question: str) -> str:
+    try:
+        image_b64, image_format = encode_image_for_vlm(image_path, image_data)
         
         # # Direct API Call
         # print("Attempting direct API call...")
@@ -767,19 +986,14 @@ def ask_about_image(image_path: str, question: str = "Describe the image") -> st
         for model in multimodal_models:
             try:
                 print(f"Trying model: {model}")
-                vlm = ChatNVIDIA(
-                    model=model,
-                    base_url=os.getenv('NVIDIA_BASE_URL', 'http://0.0.0.0:9004/v1'),
-                    max_tokens=1000,
-                    temperature=0.1
-                )
+                vlm = get_chat_model(model, max_tokens=1000, temperature=0.1)
                 message = HumanMessage(
                     content=[
                         {"type": "text", "text": question},
                         {"type": "image_url", "image_url": {"url": f"data:image/{image_format};base64,{image_b64}"}}
                     ]
                 )
-                response = vlm.invoke([message])
+                response = call_with_retry(vlm.invoke, [message])
                 return response.content
             except Exception as e:
                 print(f"Failed with {model}: {str(e)}")
@@ -787,92 +1001,693 @@ def ask_about_image(image_path: str, question: str = "Describe the image") -> st
         
         # Fallback
         print("Falling back to text-only model...")
-        text_llm = ChatNVIDIA(
-            model="meta/llama-3.3-70b-instruct",
-            base_url=os.getenv('NVIDIA_BASE_URL', 'http://0.0.0.0:9004/v1'),
-            max_tokens=1000,
-            temperature=0.1
-        )
+        text_llm = get_chat_model("meta/llama-3.3-70b-instruct", max_tokens=1000, temperature=0.1)
         fallback_message = HumanMessage(
             content=f"Cannot process image {image_path}. Provide a generic response to: {question}"
         )
-        response = text_llm.invoke([fallback_message])
+        response = call_with_retry(text_llm.invoke, [fallback_message])
         return f"[Vision unavailable] {response.content}"
     
     except Exception as e:
         print(f"Error: {str(e)}")
         return f"Unable to process {image_path}."
 
+# Micro-batched description requests
+def _describe_images_multi(image_paths: list[str], question: str) -> list[str]:
+    """
+    Describe several images in one multi-image chat request.
+    Raises ValueError if the endpoint does not return one description per image.
+    """
+    content = [{
+        "type": "text",
+        "text": f"{question}\nThere are {len(image_paths)} images. Return a JSON array of exactly "
+                f"{len(image_paths)} strings, one description per image in the order given. No other text."
+    }]
+    for image_path in image_paths:
+        with open(image_path, "rb") as image_file:
+            image_b64, image_format = encode_image_for_vlm(image_path, image_file.read())
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/{image_format};base64,{image_b64}"}})
+    
+    api_url = os.getenv('NVIDIA_BASE_URL', 'http://0.0.0.0:9004/v1') + "/chat/completions"
+    payload = {
+        "model": os.getenv('VLM_BATCH_MODEL', 'meta/llama-3.2-11b-vision-instruct'),
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": 1000 * len(image_paths),
+        "temperature": 0.1
+    }
+    response = post_with_retry(api_url, payload)
+    if response.status_code != 200:
+        raise ValueError(f"Multi-image call failed: {response.status_code} - {response.text}")
+    
+    text = response.json()['choices'][0]['message']['content'].strip()
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text)
+    descriptions = json.loads(text)
+    if not isinstance(descriptions, list) or len(descriptions) != len(image_paths) \
+            or not all(isinstance(d, str) and d.strip() for d in descriptions):
+        raise ValueError(f"Expected {len(image_paths)} descriptions, got: {text[:100]}")
+    return descriptions
+
+class DescribeBatcher:
+    """
+    Dynamic batcher in front of the VLM.
+    
+    Submitted images are grouped until max_batch_size is reached or max_wait seconds
+    have passed since the first one arrived. Each batch is dispatched on a pool of
+    `concurrency` workers, either as concurrent single-image streams or, with
+    multi_image=True, as one multi-image request (falling back per image on failure).
+    """
+    def __init__(self, question: str = "Describe the image", max_batch_size: int = 8,
+                 max_wait: float = 0.05, concurrency: int = 8, multi_image: bool = False):
+        self.question = question
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.multi_image = multi_image
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._closed = False
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+    
+    def submit(self, image_path: str) -> Future:
+        if self._closed:
+            raise RuntimeError("DescribeBatcher is closed")
+        future = Future()
+        self._queue.put((image_path, future))
+        return future
+    
+    def close(self):
+        """Flush pending requests and wait for all batches to finish."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def _collect(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._dispatch(batch)
+    
+    def _dispatch(self, batch):
+        if self.multi_image and len(batch) > 1:
+            self._executor.submit(self._describe_batch, batch)
+        else:
+            for image_path, future in batch:
+                self._executor.submit(self._describe_one, image_path, future)
+    
+    def _describe_one(self, image_path, future):
+        try:
+            future.set_result(ask_about_image(image_path, self.question))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    def _describe_batch(self, batch):
+        try:
+            descriptions = _describe_images_multi([path for path, _ in batch], self.question)
+        except Exception as e:
+            print(f"Multi-image request failed, describing {len(batch)} images individually: {str(e)}")
+            for image_path, future in batch:
+                self._describe_one(image_path, future)
+            return
+        for (_, future), description in zip(batch, descriptions):
+            future.set_result(description)
+
+def describe_images(image_paths: list[str], question: str = "Describe the image", max_batch_size: int = 8,
+                    max_wait: float = 0.05, concurrency: int = 8, multi_image: bool = False) -> list[str]:
+    """
+    Describe many images through a DescribeBatcher so throughput scales with concurrency
+    rather than per-request round-trip time. Returns descriptions in input order.
+    """
+    with DescribeBatcher(question, max_batch_size, max_wait, concurrency, multi_image) as batcher:
+        futures = [batcher.submit(path) for path in image_paths]
+    return [future.result() for future in futures]
+
 # Task 2: Image Creation
-def generate_images(prompts: list[str], n: int = 1) -> list[tuple[Image.Image, str]]:
+DIFFUSION_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+
+# Per-machine render settings written by the `autotune` command; without a profile the defaults apply
+RENDER_PROFILE_PATH = os.getenv('RENDER_PROFILE_PATH', 'render_profile.json')
+
+def machine_fingerprint() -> dict:
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return {"device": device, "cpu_count": os.cpu_count(),
+            "gpu": torch.cuda.get_device_name(0) if device == "cuda" else None}
+
+def load_render_profile(path: str = RENDER_PROFILE_PATH) -> dict:
+    """Return the autotuned render settings, or {} if there is no profile for this hardware."""
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable render profile {path}: {str(e)}")
+        return {}
+    if profile.get("machine") != machine_fingerprint():
+        print(f"Ignoring render profile {path}: it was tuned on different hardware")
+        return {}
+    print(f"Loaded render profile {path}: {profile['settings']}")
+    return profile["settings"]
+
+render_profile = load_render_profile()
+
+# Loaded pipelines are kept warm so repeated (e.g. streamed, one-prompt) calls don't reload weights
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+# Schedulers keep per-call state, so a shared pipeline runs one denoising loop at a time
+_render_lock = threading.Lock()
+
+def get_diffusion_pipeline(model_id: str = DIFFUSION_MODEL_ID):
     """
-    Generate images from a list of text prompts using Stable Diffusion and save them to disk.
-    Returns a list of tuples containing PIL Image objects and their file paths.
+    Return a loaded Stable Diffusion pipeline and its device, loading it on first use.
     """
+    with _pipelines_lock:
+        if model_id not in _pipelines:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            print(f"Using device: {device}")
+            if "threads" in render_profile:
+                torch.set_num_threads(render_profile["threads"])
+            pipeline = StableDiffusionPipeline.from_pretrained(
+                model_id,
+                torch_dtype=getattr(torch, render_profile.get("dtype", "float16")),
+                safety_checker=None,
+                requires_safety_checker=False
+            )
+            pipeline = pipeline.to(device)
+            pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
+            print(f"Successfully loaded {model_id}")
+            _pipelines[model_id] = (pipeline, device)
+        return _pipelines[model_id]
+
+def release_diffusion_pipelines():
+    """Drop all warm pipelines and free GPU memory."""
+    with _pipelines_lock:
+        _pipelines.clear()
+    torch.cuda.empty_cache()
+
+# Adaptive memory mode: give up speed only when a render would not otherwise fit
+DIFFUSION_MEMORY_MODE = os.getenv('DIFFUSION_MEMORY_MODE', 'auto')  # "auto" or one of MEMORY_MODES
+MEMORY_MODES = ("full", "sliced", "vae_sliced", "vae_tiled", "offload")  # fastest first; each saves more memory
+FRUGAL_MEMORY_MODES = ("vae_tiled", "offload")  # always slice attention and decode in VAE tiles
+MEMORY_HEADROOM = float(os.getenv('MEMORY_HEADROOM', '0.8'))  # fraction of free memory a render may plan on
+_memory_modes = {}  # id(unet) -> applied mode; txt2img and img2img pipelines share the unet
+
+def fused_attention_available() -> bool:
+    return hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
+def available_memory_mb(device: str) -> float:
+    """Free memory on the render device: CUDA free memory, otherwise MemAvailable."""
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return free / (1024 * 1024)
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"Using device: {device}")
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def module_size_mb(module) -> float:
+    return sum(p.numel() * p.element_size() for p in module.parameters()) / (1024 * 1024)
+
+def estimate_render_memory_mb(pipeline, width: int, height: int, batch_size: int = 1) -> dict:
+    """
+    Rough activation memory in MB for one render under each mode.
+    Classifier-free guidance doubles the UNet batch. Without fused attention the largest
+    self-attention layer materializes a heads x tokens x tokens score matrix, which slicing
+    cuts to one matrix at a time. VAE decode holds a few 128-channel full-resolution maps
+    per image; VAE slicing decodes one image at a time and VAE tiling one tile of one image.
+    """
+    dtype_bytes = pipeline.unet.dtype.itemsize
+    tokens = (width // 8) * (height // 8)
+    unet_batch = 2 * batch_size
+    features = unet_batch * tokens * 320 * dtype_bytes * 40
+    scores = 0 if fused_attention_available() else unet_batch * 8 * tokens ** 2 * dtype_bytes
+    sliced_scores = min(scores, tokens ** 2 * dtype_bytes)
+    decode = 6 * width * height * 128 * dtype_bytes
+    tile = getattr(pipeline.vae, "tile_sample_min_size", 512)
+    tiled_decode = 6 * min(width, tile) * min(height, tile) * 128 * dtype_bytes
+    estimates = {
+        "full": features + scores + decode * batch_size,
+        "sliced": features + sliced_scores + decode * batch_size,
+        "vae_sliced": features + sliced_scores + decode,
+        "vae_tiled": features + sliced_scores + tiled_decode,
+        "offload": features + sliced_scores + tiled_decode,
+    }
+    return {mode: size / (1024 * 1024) for mode, size in estimates.items()}
+
+def choose_memory_mode(pipeline, device: str, width: int, height: int, batch_size: int = 1) -> tuple[str, str]:
+    """Pick the fastest mode whose estimate fits in free memory. Returns (mode, reason)."""
+    if DIFFUSION_MEMORY_MODE in MEMORY_MODES:
+        return DIFFUSION_MEMORY_MODE, "set by DIFFUSION_MEMORY_MODE"
+    
+    estimates = estimate_render_memory_mb(pipeline, width, height, batch_size)
+    budget = available_memory_mb(device) * MEMORY_HEADROOM
+    # An autotuned profile names the fastest mode on this machine; only more frugal ones are tried after it
+    preferred = render_profile.get("memory_mode", "full")
+    for mode in MEMORY_MODES[MEMORY_MODES.index(preferred):]:
+        mode_budget = budget
+        if mode == "sliced" and fused_attention_available() and preferred != "sliced":
+            continue  # fused attention is already memory-efficient; slicing would only slow it down
+        if mode == "offload":
+            if device != "cuda":
+                continue
+            if _memory_modes.get(id(pipeline.unet)) != "offload":
+                # Offloading keeps only the active submodule on the GPU, freeing most of the weights
+                weights = sum(module_size_mb(m) for m in (pipeline.unet, pipeline.vae, pipeline.text_encoder))
+                mode_budget += (weights - module_size_mb(pipeline.unet)) * MEMORY_HEADROOM
+        if estimates[mode] <= mode_budget:
+            return mode, f"needs ~{estimates[mode]:.0f} MB of {mode_budget:.0f} MB available"
+    fallback = "offload" if device == "cuda" else "vae_tiled"
+    return fallback, f"needs ~{estimates[fallback]:.0f} MB but only {budget:.0f} MB available; using the most frugal mode"
+
+def apply_memory_mode(pipeline, device: str, mode: str):
+    """Switch the pipeline's attention slicing, VAE slicing and tiling and CPU offload to match `mode`."""
+    key = id(pipeline.unet)
+    current = _memory_modes.get(key, "full")  # freshly loaded pipelines run with full attention
+    if mode != current:
+        if current == "offload":
+            pipeline.remove_all_hooks()
+            pipeline.to(device)
+        if mode in ("sliced",) + FRUGAL_MEMORY_MODES or (mode != "full" and not fused_attention_available()):
+            pipeline.enable_attention_slicing("max")
+        else:
+            pipeline.disable_attention_slicing()
+        if mode in ("vae_sliced",) + FRUGAL_MEMORY_MODES:
+            pipeline.vae.enable_slicing()
+        else:
+            pipeline.vae.disable_slicing()
+        # Slicing only splits a batch; tiling is what bounds the decode of a single image
+        if mode in FRUGAL_MEMORY_MODES:
+            pipeline.vae.enable_tiling()
+        else:
+            pipeline.vae.disable_tiling()
+        if mode == "offload":
+            pipeline.enable_sequential_cpu_offload()
+    _memory_modes[key] = mode
+
+def configure_memory_mode(pipeline, device: str, width: int = 512, height: int = 512, batch_size: int = 1) -> str:
+    """
+    Re-evaluate the memory mode for the upcoming render and apply it, reporting changes.
+    Call it inside the same _render_lock block as the render, so no other call can switch
+    the mode between configuring and rendering.
+    """
+    mode, reason = choose_memory_mode(pipeline, device, width, height, batch_size)
+    if device != "cuda" and mode == "offload":
+        mode, reason = "vae_tiled", "CPU offload needs a GPU"
+    if mode != _memory_modes.get(id(pipeline.unet)):
+        print(f"Memory mode for {width}x{height} x{batch_size}: {mode} ({reason})")
+    try:
+        apply_memory_mode(pipeline, device, mode)
+    except Exception as e:
+        print(f"Could not switch to memory mode {mode}: {str(e)}")
+    return _memory_modes.get(id(pipeline.unet), "full")
+
+# Memory-bounded high-resolution rendering
+HIGH_RES_TILE_SIZE = int(os.getenv('HIGH_RES_TILE_SIZE', '512'))  # pixels; larger renders are tiled
+HIGH_RES_TILE_OVERLAP = int(os.getenv('HIGH_RES_TILE_OVERLAP', '128'))
+
+def _tile_starts(length: int, tile: int, stride: int) -> list[int]:
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    return starts + [length - tile]
+
+def _tile_weights(height: int, width: int, overlap: int, device) -> torch.Tensor:
+    """Feathered weights that ramp up across the overlap so neighbouring tiles blend without seams."""
+    def ramp(size):
+        positions = torch.arange(size, device=device, dtype=torch.float32)
+        return torch.clamp(torch.minimum(positions + 1, size - positions) / max(overlap, 1), max=1.0)
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
+def render_tiled(pipeline, device: str, prompt: str, width: int, height: int, generator,
+                 num_inference_steps: int = 20, guidance_scale: float = 7.5,
+                 tile_size: int = HIGH_RES_TILE_SIZE, tile_overlap: int = HIGH_RES_TILE_OVERLAP,
+                 output_type: str = "pil"):
+    """
+    Render an image larger than tile_size with bounded memory.
+    
+    At every step the UNet predicts noise for overlapping latent tiles, which are blended
+    with feathered weights into one prediction for the whole latent before the scheduler
+    step, so any scheduler works unchanged. The VAE then decodes with tiling enabled.
+    Peak memory follows the tile size rather than the output resolution.
+    """
+    scale = pipeline.vae_scale_factor
+    tile, overlap = tile_size // scale, tile_overlap // scale
+    stride = max(1, tile - overlap)
+    
+    prompt_embeds, negative_embeds = pipeline.encode_prompt(prompt, device, 1, True)
+    text_embeddings = torch.cat([negative_embeds, prompt_embeds])
+    latents = pipeline.prepare_latents(1, pipeline.unet.config.in_channels, height, width,
+                                       prompt_embeds.dtype, device, generator)
+    latent_h, latent_w = latents.shape[-2:]
+    windows = [(y, x) for y in _tile_starts(latent_h, tile, stride) for x in _tile_starts(latent_w, tile, stride)]
+    tile_h, tile_w = min(tile, latent_h), min(tile, latent_w)
+    weights = _tile_weights(tile_h, tile_w, overlap, device)
+    total_weights = torch.zeros(latent_h, latent_w, device=device)
+    for y, x in windows:
+        total_weights[y:y + tile_h, x:x + tile_w] += weights
+    
+    pipeline.scheduler.set_timesteps(num_inference_steps, device=device)
+    with torch.no_grad():
+        for t in pipeline.scheduler.timesteps:
+            model_input = pipeline.scheduler.scale_model_input(torch.cat([latents] * 2), t)
+            noise_pred = torch.zeros_like(latents)
+            for y, x in windows:
+                tile_input = model_input[:, :, y:y + tile_h, x:x + tile_w]
+                tile_noise = pipeline.unet(tile_input, t, encoder_hidden_states=text_embeddings).sample
+                uncond, text = tile_noise.chunk(2)
+                guided = uncond + guidance_scale * (text - uncond)
+                noise_pred[:, :, y:y + tile_h, x:x + tile_w] += guided * weights
+            noise_pred /= total_weights
+            latents = pipeline.scheduler.step(noise_pred, t, latents).prev_sample
         
-        model_id = "runwayml/stable-diffusion-v1-5"
-        pipeline = StableDiffusionPipeline.from_pretrained(
-            model_id,
-            torch_dtype=torch.float16,
-            safety_checker=None,
-            requires_safety_checker=False
-        )
-        pipeline = pipeline.to(device)
-        pipeline.enable_attention_slicing()
-        pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
-        print(f"Successfully loaded {model_id}")
+        was_tiling = pipeline.vae.use_tiling  # left on when the memory mode asked for it
+        pipeline.vae.enable_tiling()
+        try:
+            decoded = pipeline.vae.decode(latents / pipeline.vae.config.scaling_factor).sample
+        finally:
+            if not was_tiling:
+                pipeline.vae.disable_tiling()
+    return pipeline.image_processor.postprocess(decoded, output_type=output_type)[0]
+
+# Draft renders: denoise at a reduced size, upscale on the CPU, optionally refine at full size
+def draft_dimensions(width: int, height: int, draft_size: int) -> tuple[int, int]:
+    """Scale (width, height) so the long side is at most draft_size, on the 8px latent grid."""
+    scale = min(1.0, draft_size / max(width, height))
+    return max(64, round(width * scale / 8) * 8), max(64, round(height * scale / 8) * 8)
+
+def store_image_array(batch: np.ndarray, index: int, image: np.ndarray) -> np.ndarray:
+    """
+    Quantize one float [0, 1] H x W x 3 pipeline output into batch[index] in place
+    (uint8 images are copied as they are).
+    Returns the batch slot, a view rather than a copy.
+    """
+    if image.dtype == np.uint8:
+        batch[index] = image
+        return batch[index]
+    np.multiply(image, 255, out=image)
+    np.rint(image, out=image)
+    batch[index] = image
+    return batch[index]
+
+def validate_render_options(width: int, height: int, draft_size: int | None, refine_strength: float):
+    """Reject sizes the pipeline cannot render and draft/refine settings that would otherwise be silently ignored."""
+    if width <= 0 or height <= 0 or width % 8 or height % 8:
+        raise ValueError(f"width and height must be positive multiples of 8, got {width}x{height}")
+    if draft_size is not None and draft_size < 8:
+        raise ValueError(f"draft_size must be at least 8, got {draft_size}")
+    if not 0.0 <= refine_strength <= 1.0:
+        raise ValueError(f"refine_strength must be between 0 and 1, got {refine_strength}")
+    if refine_strength > 0 and max(width, height) > HIGH_RES_TILE_SIZE:
+        # The refinement is a full-size img2img pass, which would undo the memory bound of tiling
+        raise ValueError(f"refine_strength is only supported up to {HIGH_RES_TILE_SIZE}px, got {width}x{height}")
+
+def placeholder_batch(count: int, width: int = 512, height: int = 512) -> np.ndarray:
+    """Light gray uint8 stand-ins for renders that failed, matching generate_images' np output."""
+    return np.full((count, height, width, 3), 211, dtype=np.uint8)
+
+def output_stamp() -> str:
+    """Timestamp plus a random suffix, so calls landing in the same second never share file names."""
+    return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+def generate_images(prompts: list[str], n: int = 1, coalesce: bool = False,
+                    start_index: int = 0, dedupe: str | None = None, dedupe_threshold: float | None = None,
+                    output_dir: str = "generated_images", width: int = 512, height: int = 512,
+                    output_type: str = "pil", draft_size: int | None = None,
+                    refine_strength: float = 0.0) -> list[tuple[Image.Image, str]] | tuple[np.ndarray, list[str]]:
+    """
+    Generate images from a list of text prompts using Stable Diffusion and save them to disk.
+    Returns a list of tuples containing PIL Image objects and their file paths, or with
+    output_type="np" a (batch, paths) pair where batch is one contiguous N x H x W x 3
+    uint8 array; no PIL images are created for the caller, so treat batch as read-only.
+    With coalesce=True, concurrent calls for the same prompts share one render job.
+    start_index offsets seeds and filenames when prompts arrive one at a time.
+    dedupe="collapse" skips prompts that are near-duplicates of an earlier one, so the result
+    is shorter than prompts: one render per distinct prompt, in order, each keeping the seed
+    and filename index of its original slot;
+    dedupe="diversify" rewrites them into distinct prompts before rendering.
+    Sizes above HIGH_RES_TILE_SIZE are rendered tiled to keep memory bounded.
+    draft_size (e.g. 256 or 384) denoises at that long side, tiled if it is still above
+    HIGH_RES_TILE_SIZE, and Lanczos-upscales to the requested size. refine_strength > 0 then
+    runs that fraction of the schedule as img2img at full size, with or without a draft.
+    Raises ValueError for draft/refine settings that cannot be honoured.
+    """
+    validate_render_options(width, height, draft_size, refine_strength)
+    options = {"output_dir": output_dir, "width": width, "height": height, "output_type": output_type,
+               "draft_size": draft_size, "refine_strength": refine_strength}
+    if coalesce:
+        key = ("render", tuple(prompts), n, start_index, dedupe, dedupe_threshold, tuple(sorted(options.items())))
+        result = single_flight(key, generate_images, prompts, n, start_index=start_index,
+                               dedupe=dedupe, dedupe_threshold=dedupe_threshold, **options)
+        return result if output_type == "np" else list(result)
+    
+    dedupe_threshold = PROMPT_DEDUPE_THRESHOLD if dedupe_threshold is None else dedupe_threshold
+    if dedupe == "diversify":
+        prompts = diversify_prompts(prompts, dedupe_threshold)
+    slots = list(range(start_index, start_index + len(prompts)))
+    if dedupe == "collapse":
+        unique = sorted(set(collapse_prompts(prompts, dedupe_threshold)))
+        if len(unique) < len(prompts):
+            print(f"Skipping {len(prompts) - len(unique)} near-duplicate prompts; rendering {len(unique)} of {len(prompts)}")
+            prompts = [prompts[k] for k in unique]
+            slots = [start_index + k for k in unique]
+    
+    stamp = output_stamp()
+    try:
+        pipeline, device = get_diffusion_pipeline()
         
         # Create output directory
-        output_dir = "generated_images"
         os.makedirs(output_dir, exist_ok=True)
         
+        render_width, render_height = draft_dimensions(width, height, draft_size) if draft_size else (width, height)
+        drafted = (render_width, render_height) != (width, height)
+        refiner = get_img2img_pipeline()[0] if refine_strength > 0 else None
+        # Drafts too large for one pass are tiled like any other high-resolution render
+        tiled = max(render_width, render_height) > HIGH_RES_TILE_SIZE
+        if tiled:
+            print(f"Rendering {render_width}x{render_height} in {HIGH_RES_TILE_SIZE}px tiles with tiled VAE decode")
+        if drafted:
+            print(f"Rendering drafts at {render_width}x{render_height}, upscaling to {width}x{height}")
+        if refiner is not None:
+            print(f"Refining at {width}x{height} with img2img strength {refine_strength}")
+        # Upscaling and refining work on PIL images; otherwise the pipeline returns the final type
+        stage_type = "pil" if drafted or refiner is not None else output_type
+        # Prompts are denoised together in batches of the autotuned size; each keeps its own seed
+        batch_size = 1 if tiled else max(1, min(render_profile.get("batch_size", 1), len(prompts)))
+        # Tiled renders only ever denoise and decode one tile-sized region at a time
+        memory_width, memory_height = (width, height) if refiner else (render_width, render_height)
+        memory_width, memory_height = min(memory_width, HIGH_RES_TILE_SIZE), min(memory_height, HIGH_RES_TILE_SIZE)
+        
+        # With output_type="np" every render is written straight into one preallocated uint8 batch
+        batch = np.empty((len(prompts), height, width, 3), dtype=np.uint8) if output_type == "np" else None
+        images_with_paths = []
+        for offset in range(0, len(prompts), batch_size):
+            group = prompts[offset:offset + batch_size]
+            indices = slots[offset:offset + len(group)]
+            for i, prompt in zip(indices, group):
+                print(f"Generating image {i+1} for prompt: {prompt}")
+            generators = [torch.Generator(device=device).manual_seed(42 + i) for i in indices]
+            with _render_lock, torch.autocast(device, enabled=render_profile.get("autocast", True)):
+                configure_memory_mode(pipeline, device, memory_width, memory_height, len(group))
+                if tiled:
+                    images = [render_tiled(pipeline, device, group[0], render_width, render_height, generators[0],
+                                           output_type=stage_type)]
+                else:
+                    images = pipeline(
+                        group,
+                        num_inference_steps=20,
+                        guidance_scale=7.5,
+                        width=render_width,
+                        height=render_height,
+                        generator=generators,
+                        output_type=stage_type
+                    ).images
+                if drafted:
+                    images = [draft.resize((width, height), Image.Resampling.LANCZOS) for draft in images]
+                if refiner is not None:
+                    images = refiner(
+                        group,
+                        image=images,
+                        strength=refine_strength,
+                        num_inference_steps=20,
+                        guidance_scale=7.5,
+                        generator=generators,
+                        output_type=output_type
+                    ).images
+                elif stage_type != output_type:
+                    images = [np.asarray(image) for image in images]
+            
+            for position, i, image in zip(itertools.count(offset), indices, images):
+                # Save the image with a unique filename
+                filename = f"generated_{stamp}_{i:03d}.png"
+                filepath = os.path.join(output_dir, filename)
+                if batch is not None:
+                    image = store_image_array(batch, position, image)
+                    Image.fromarray(image).save(filepath)
+                else:
+                    image.save(filepath)
+                print(f"Saved image to: {filepath}")
+                images_with_paths.append((image, filepath))
+        
+        if batch is not None:
+            return batch, [path for _, path in images_with_paths]
+        return images_with_paths
+    
+    except Exception as e:
+        print(f"Error in generate_images: {str(e)}")
+        placeholder_path = os.path.join(output_dir, f"placeholder_{stamp}_{start_index:03d}.png")
+        if output_type == "np":
+            return placeholder_batch(len(prompts), width, height), [placeholder_path] * len(prompts)
+        return [(Image.new('RGB', (width, height), color='lightgray'), placeholder_path) for _ in range(len(prompts))]
+
+# Image-to-image fast path
+IMG2IMG_STRENGTH = float(os.getenv('IMG2IMG_STRENGTH', '0.6'))
+IMG2IMG_DEFAULT_PROMPT = "high quality, detailed, sharp focus"
+
+def get_img2img_pipeline(model_id: str = DIFFUSION_MODEL_ID):
+    """Return an img2img pipeline that shares the warm text-to-image pipeline's weights."""
+    pipeline, device = get_diffusion_pipeline(model_id)
+    key = f"{model_id}:img2img"
+    with _pipelines_lock:
+        if key not in _pipelines:
+            img2img = StableDiffusionImg2ImgPipeline(**pipeline.components, requires_safety_checker=False)
+            _pipelines[key] = (img2img, device)
+        return _pipelines[key]
+
+def generate_image_variations(image_path: str, prompts: list[str], num_images: int = 4,
+                              strength: float = IMG2IMG_STRENGTH, output_dir: str = "generated_images",
+                              width: int = 512, height: int = 512,
+                              output_type: str = "pil") -> list[tuple[Image.Image, str]] | tuple[np.ndarray, list[str]]:
+    """
+    Generate variations of an input image without going through text.
+    The input is VAE-encoded once and that latent seeds every variation; only the last
+    `strength` fraction of the 20-step schedule is denoised for each one.
+    Returns the same shapes as generate_images for the given output_type.
+    """
+    stamp = output_stamp()
+    try:
+        pipeline, device = get_img2img_pipeline()
+        os.makedirs(output_dir, exist_ok=True)
+        
+        with Image.open(image_path) as img:
+            init_image = img.convert("RGB").resize((width, height), Image.Resampling.LANCZOS)
+        with _render_lock, torch.no_grad():
+            configure_memory_mode(pipeline, device, width, height)
+            pixels = pipeline.image_processor.preprocess(init_image).to(device=device, dtype=pipeline.vae.dtype)
+            latent_dist = pipeline.vae.encode(pixels).latent_dist
+            init_latents = latent_dist.sample(torch.Generator(device=device).manual_seed(42)) * pipeline.vae.config.scaling_factor
+        print(f"Encoded {image_path} once; each variation runs {int(20 * strength)} of 20 denoising steps")
+        
+        batch = np.empty((num_images, height, width, 3), dtype=np.uint8) if output_type == "np" else None
         images_with_paths = []
-        for i, prompt in enumerate(prompts):
-            print(f"Generating image {i+1}/{len(prompts)} for prompt: {prompt}")
-            with torch.autocast(device):
+        for i in range(num_images):
+            prompt = prompts[i % len(prompts)]
+            print(f"Generating variation {i+1}/{num_images} for prompt: {prompt}")
+            with _render_lock, torch.autocast(device, enabled=render_profile.get("autocast", True)):
+                configure_memory_mode(pipeline, device, width, height)
                 image = pipeline(
                     prompt,
+                    image=init_latents,  # 4-channel latents skip the VAE encode inside the pipeline
+                    strength=strength,
                     num_inference_steps=20,
                     guidance_scale=7.5,
-                    width=512,
-                    height=512,
-                    generator=torch.Generator(device=device).manual_seed(42 + i)
+                    generator=torch.Generator(device=device).manual_seed(42 + i),
+                    output_type=output_type
                 ).images[0]
             
-            # Save the image with a unique filename
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"generated_{timestamp}_{i:03d}.png"
-            filepath = os.path.join(output_dir, filename)
-            image.save(filepath)
+            filepath = os.path.join(output_dir, f"variation_{stamp}_{i:03d}.png")
+            if batch is not None:
+                image = store_image_array(batch, i, image)
+                Image.fromarray(image).save(filepath)
+            else:
+                image.save(filepath)
             print(f"Saved image to: {filepath}")
             images_with_paths.append((image, filepath))
-        
-        del pipeline
-        torch.cuda.empty_cache()
+        if batch is not None:
+            return batch, [path for _, path in images_with_paths]
         return images_with_paths
     
     except Exception as e:
-        print(f"Error in generate_images: {str(e)}")
-        placeholder_path = f"generated_images/placeholder_{datetime.now().strftime('%Y%m%d_%H%M%S')}_000.png"
-        return [(Image.new('RGB', (512, 512), color='lightgray'), placeholder_path) for _ in range(len(prompts))]
+        print(f"Error in generate_image_variations: {str(e)}")
+        placeholder_path = os.path.join(output_dir, f"placeholder_{stamp}_000.png")
+        if output_type == "np":
+            return placeholder_batch(num_images, width, height), [placeholder_path] * num_images
+        return [(Image.new('RGB', (width, height), color='lightgray'), placeholder_path) for _ in range(num_images)]
 
-# Task 3: Prompt Synthesis
-def llm_rewrite_to_image_prompts(user_query: str, n: int = 4) -> list[str]:
+# Headless contact sheets
+def build_contact_sheet(images, output_path: str, cols: int = 4, rows: int | None = None,
+                        tile_size: int = 256, padding: int = 4) -> str:
     """
-    Transform a complex image description into multiple focused diffusion prompts.
+    Compose images into one rows x cols grid and write it with a single encode.
+    
+    `images` may hold PIL images, H x W x 3 uint8 arrays (or be an N x H x W x 3 batch)
+    or file paths. Each one is thumbnailed and pasted as soon as it is read, so only the
+    sheet and one image are held at a time; pass `rows` to stream a generator without
+    materializing it.
+    Returns the path of the written sheet.
     """
-    try:
-        llm = ChatNVIDIA(
-            model="meta/llama-3.3-70b-instruct",
-            base_url=os.getenv('NVIDIA_BASE_URL', 'http://0.0.0.0:9004/v1'),
-            max_tokens=2000,
-            temperature=0.7
-        )
+    if rows is None:
+        images = list(images)
+        rows = max(1, math.ceil(len(images) / cols))
+    
+    step = tile_size + padding
+    sheet = Image.new('RGB', (cols * step + padding, rows * step + padding), color='white')
+    for i, item in enumerate(itertools.islice(images, rows * cols)):
+        try:
+            if isinstance(item, np.ndarray):
+                # Subsample through a strided view so only ~2x the tile's pixels are copied
+                stride = max(1, max(item.shape[:2]) // (2 * tile_size))
+                item = Image.fromarray(np.ascontiguousarray(item[::stride, ::stride]))
+            if isinstance(item, Image.Image):
+                scale = tile_size / max(item.size)
+                size = (max(1, round(item.width * scale)), max(1, round(item.height * scale)))
+                thumb = item.convert('RGB').resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+            else:
+                with Image.open(item) as img:
+                    img.draft('RGB', (tile_size, tile_size))  # lets JPEG decode at reduced scale
+                    img.thumbnail((tile_size, tile_size), Image.Resampling.LANCZOS, reducing_gap=2.0)
+                    thumb = img.convert('RGB')
+        except Exception as e:
+            print(f"Error loading image {i + 1} for contact sheet: {e}")
+            thumb = Image.new('RGB', (tile_size, tile_size), color='lightgray')
         
-        prompt_template = ChatPromptTemplate.from_template("""
+        row, col = divmod(i, cols)
+        x = padding + col * step + (tile_size - thumb.width) // 2
+        y = padding + row * step + (tile_size - thumb.height) // 2
+        sheet.paste(thumb, (x, y))
+    
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    sheet.save(output_path)
+    return output_path
+
+# Task 3: Prompt Synthesis
+REWRITE_PROMPT_TEMPLATE = """
 You are an expert prompt engineer specializing in text-to-image generation. Your task is to transform complex image descriptions into clean, focused prompts that work well with diffusion models like Stable Diffusion.
 
 ORIGINAL DESCRIPTION:
@@ -902,13 +1717,31 @@ EXAMPLE FORMAT:
 2. [prompt 2]
 3. [prompt 3]
 4. [prompt 4]
-""")
-        
-        chain = prompt_template | llm | StrOutputParser()
+"""
+
+def build_rewrite_chain():
+    """Build the template | LLM | parser chain used to rewrite a description into prompts."""
+    llm = get_chat_model("meta/llama-3.3-70b-instruct", max_tokens=2000, temperature=0.7)
+    prompt_template = ChatPromptTemplate.from_template(REWRITE_PROMPT_TEMPLATE)
+    return prompt_template | llm | StrOutputParser()
+
+def llm_rewrite_to_image_prompts(user_query: str, n: int = 4, fallback: bool = True) -> list[str] | None:
+    """
+    Transform a complex image description into multiple focused diffusion prompts.
+    Concurrent calls for the same description and count share one LLM request.
+    If the LLM fails, keyword-based fallback prompts are returned, or None with fallback=False.
+    """
+    key = ("rewrite", user_query, n, fallback)
+    prompts = single_flight(key, _rewrite_to_image_prompts, user_query, n, fallback)
+    return list(prompts) if prompts is not None else None
+
+def _rewrite_to_image_prompts(user_query: str, n: int, fallback: bool = True) -> list[str] | None:
+    try:
+        chain = build_rewrite_chain()
         print(f"Generating {n} synthetic prompts from description...")
         print(f"Original description: {user_query[:100]}...")
         
-        response = chain.invoke({"description": user_query, "n": n})
+        response = call_with_retry(chain.invoke, {"description": user_query, "n": n})
         sd_prompts = parse_prompts_from_response(response, n)
         sd_prompts = validate_and_clean_prompts(sd_prompts, n)
         
@@ -921,30 +1754,197 @@ EXAMPLE FORMAT:
         
     except Exception as e:
         print(f"Error in llm_rewrite_to_image_prompts: {str(e)}")
-        return create_fallback_prompts(user_query, n)
+        return create_fallback_prompts(user_query, n) if fallback else None
+
+def llm_stream_image_prompts(user_query: str, n: int = 4, fallback: bool = True):
+    """
+    Streaming variant of llm_rewrite_to_image_prompts.
+    Yields each cleaned prompt as soon as its numbered line is complete, so rendering
+    can start before the LLM finishes. Always yields exactly n prompts, unless the LLM
+    fails with fallback=False, in which case it stops after the prompts it produced.
+    """
+    sd_prompts = []
+    try:
+        chain = build_rewrite_chain()
+        print(f"Streaming {n} synthetic prompts from description...")
+        
+        def open_stream():
+            # Only the connection is retried; a stream that fails midway keeps what it produced
+            chunks = iter(chain.stream({"description": user_query, "n": n}))
+            return itertools.chain([next(chunks, "")], chunks)
+        
+        buffer = ""
+        for chunk in call_with_retry(open_stream):
+            buffer += chunk
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                prompt = parse_prompt_line(line)
+                prompt = clean_prompt(prompt) if prompt else None
+                if prompt and len(sd_prompts) < n:
+                    sd_prompts.append(prompt)
+                    yield prompt
+            if len(sd_prompts) == n:
+                return
+        
+        # The last line may arrive without a trailing newline
+        prompt = parse_prompt_line(buffer)
+        prompt = clean_prompt(prompt) if prompt else None
+        if prompt and len(sd_prompts) < n:
+            sd_prompts.append(prompt)
+            yield prompt
+        remaining = validate_and_clean_prompts(sd_prompts, n)[len(sd_prompts):]
+    
+    except Exception as e:
+        print(f"Error in llm_stream_image_prompts: {str(e)}")
+        remaining = create_fallback_prompts(user_query, n)[len(sd_prompts):] if fallback else []
+    
+    yield from remaining
+
+# Batched prompt synthesis: several descriptions per LLM request
+BATCH_PROMPTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "prompts": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["id", "prompts"]
+            }
+        }
+    },
+    "required": ["results"]
+}
+
+BATCH_REWRITE_PROMPT_TEMPLATE = """
+You are an expert prompt engineer specializing in text-to-image generation. Your task is to transform complex image descriptions into clean, focused prompts that work well with diffusion models like Stable Diffusion.
+
+ORIGINAL DESCRIPTIONS (JSON, each with an id):
+{descriptions}
+
+TASK: For EACH description, create {n} different high-quality prompts for image generation. Each prompt should:
+
+1. Be concise and focused (ideally 10-20 words)
+2. Emphasize different aspects of its original description
+3. Use artistic terminology that diffusion models respond well to
+4. Include quality enhancers like "high quality", "detailed", "professional"
+5. Focus on visual elements: colors, lighting, composition, style, mood
+
+FORMAT: Return only a JSON object matching this JSON schema, with one entry per description id and exactly {n} prompts per entry. No additional text or explanation.
+{schema}
+"""
+
+def llm_rewrite_many_to_image_prompts(descriptions: list[str], n: int = 4, batch_size: int = 4,
+                                      fallback: bool = True) -> list[list[str] | None]:
+    """
+    Transform several image descriptions into n diffusion prompts each.
+    Up to batch_size descriptions are packed into one request that asks the endpoint for
+    structured output against BATCH_PROMPTS_SCHEMA; endpoints without structured output
+    support get the schema in the prompt text and the reply is parsed as JSON. Any
+    description whose prompts fail validation falls back to llm_rewrite_to_image_prompts;
+    with fallback=False, descriptions the LLM could not handle at all come back as None.
+    """
+    results = [None] * len(descriptions)
+    try:
+        llm = get_chat_model("meta/llama-3.3-70b-instruct", max_tokens=2000, temperature=0.7)
+        
+        prompt_template = ChatPromptTemplate.from_template(BATCH_REWRITE_PROMPT_TEMPLATE)
+        text_chain = prompt_template | llm | StrOutputParser()
+        try:
+            structured_chain = prompt_template | llm.with_structured_output(BATCH_PROMPTS_SCHEMA)
+        except Exception as e:
+            print(f"Structured output not available, parsing text responses: {str(e)}")
+            structured_chain = None
+        
+        for start in range(0, len(descriptions), batch_size):
+            batch = descriptions[start:start + batch_size]
+            print(f"Generating {n} prompts each for descriptions {start + 1}-{start + len(batch)} in one request...")
+            inputs = {
+                "descriptions": json.dumps([{"id": i, "description": d} for i, d in enumerate(batch)], indent=2),
+                "n": n,
+                "schema": json.dumps(BATCH_PROMPTS_SCHEMA)
+            }
+            try:
+                response = None
+                if structured_chain is not None:
+                    try:
+                        response = call_with_retry(structured_chain.invoke, inputs)
+                    except Exception as e:
+                        print(f"Structured output request failed, retrying as text: {str(e)}")
+                if not isinstance(response, dict) or "results" not in response:
+                    response = call_with_retry(text_chain.invoke, inputs)
+                for i, prompts in enumerate(parse_batch_prompts_from_response(response, len(batch), n)):
+                    results[start + i] = prompts
+            except Exception as e:
+                print(f"Batched prompt request failed: {str(e)}")
+    
+    except Exception as e:
+        print(f"Error in llm_rewrite_many_to_image_prompts: {str(e)}")
+    
+    for i, prompts in enumerate(results):
+        if prompts is None:
+            print(f"Falling back to an individual request for description {i + 1}")
+            results[i] = llm_rewrite_to_image_prompts(descriptions[i], n, fallback)
+    return results
+
+def parse_batch_prompts_from_response(response: str | dict, count: int, n: int) -> list[list[str] | None]:
+    """
+    Parse a batched JSON response (text, or an already-parsed structured output object)
+    into one prompt list per description id.
+    Entries that are missing or have fewer than n valid prompts are returned as None.
+    """
+    if isinstance(response, dict):
+        data = response
+    else:
+        text = re.sub(r'^```(?:json)?\s*|\s*```$', '', response.strip())
+        data = json.loads(text)
+    parsed = [None] * count
+    for entry in data.get("results", []):
+        try:
+            index = int(entry["id"])
+            raw_prompts = [str(p) for p in entry["prompts"]]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not 0 <= index < count:
+            continue
+        prompts = parse_prompts_from_response("\n".join(raw_prompts), n)
+        cleaned = [c for c in map(clean_prompt, prompts) if c]
+        if len(cleaned) == n:
+            parsed[index] = validate_and_clean_prompts(cleaned, n)
+    return parsed
+
+def parse_prompt_line(line: str) -> str | None:
+    """Strip numbering from one response line, returning None if nothing usable is left."""
+    cleaned_line = re.sub(r'^\d+\.\s*', '', line.strip()).strip()
+    if len(cleaned_line) > 5:
+        return cleaned_line
+    return None
 
 def parse_prompts_from_response(response: str, expected_count: int) -> list[str]:
     prompts = []
     lines = response.strip().split('\n')
     for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        cleaned_line = re.sub(r'^\d+\.\s*', '', line).strip()
-        if len(cleaned_line) > 5:
+        cleaned_line = parse_prompt_line(line)
+        if cleaned_line:
             prompts.append(cleaned_line)
     return prompts[:expected_count]
 
+def clean_prompt(prompt: str) -> str | None:
+    """Clean a single prompt, returning None if it is unsuitable for diffusion."""
+    prompt = prompt.strip().strip('"\'').rstrip(',')
+    quality_indicators = ['high quality', 'detailed', 'professional', 'masterpiece']
+    has_quality = any(indicator in prompt.lower() for indicator in quality_indicators)
+    if not has_quality:
+        prompt += ", high quality, detailed"
+    if 10 <= len(prompt) <= 200:
+        return prompt
+    return None
+
 def validate_and_clean_prompts(prompts: list[str], expected_count: int) -> list[str]:
-    cleaned_prompts = []
-    for prompt in prompts:
-        prompt = prompt.strip().strip('"\'').rstrip(',')
-        quality_indicators = ['high quality', 'detailed', 'professional', 'masterpiece']
-        has_quality = any(indicator in prompt.lower() for indicator in quality_indicators)
-        if not has_quality:
-            prompt += ", high quality, detailed"
-        if 10 <= len(prompt) <= 200:
-            cleaned_prompts.append(prompt)
+    cleaned_prompts = [cleaned for cleaned in map(clean_prompt, prompts) if cleaned]
     
     while len(cleaned_prompts) < expected_count:
         if cleaned_prompts:
@@ -956,12 +1956,13 @@ def validate_and_clean_prompts(prompts: list[str], expected_count: int) -> list[
     
     return cleaned_prompts[:expected_count]
 
+STYLE_VARIATIONS = [
+    "cinematic lighting", "dramatic shadows", "vibrant colors", "soft lighting",
+    "artistic composition", "professional photography", "studio lighting", "natural lighting"
+]
+
 def create_prompt_variation(base_prompt: str) -> str:
-    style_variations = [
-        "cinematic lighting", "dramatic shadows", "vibrant colors", "soft lighting",
-        "artistic composition", "professional photography", "studio lighting", "natural lighting"
-    ]
-    return f"{base_prompt}, {random.choice(style_variations)}"
+    return f"{base_prompt}, {random.choice(STYLE_VARIATIONS)}"
 
 def create_fallback_prompts(original_description: str, n: int) -> list[str]:
     print("Creating fallback prompts...")
@@ -999,76 +2000,1311 @@ def extract_visual_keywords(text: str) -> list[str]:
             keywords.append(term)
     return keywords[:5]
 
+# Near-duplicate prompt detection before rendering
+PROMPT_DEDUPE_MODE = os.getenv('PROMPT_DEDUPE_MODE', 'collapse')  # "collapse", "diversify" or "off"
+PROMPT_DEDUPE_THRESHOLD = float(os.getenv('PROMPT_DEDUPE_THRESHOLD', '0.8'))
+
+# Filler and quality boilerplate shared by almost every prompt; ignoring it keeps scores meaningful
+PROMPT_STOPWORDS = {
+    'a', 'an', 'the', 'of', 'and', 'with', 'in', 'on', 'at', 'to', 'by',
+    'high', 'quality', 'detailed', 'professional', 'masterpiece'
+}
+
+def prompt_tokens(prompt: str) -> frozenset[str]:
+    return frozenset(re.findall(r'[a-z0-9]+', prompt.lower())) - PROMPT_STOPWORDS
+
+def prompt_similarity(a: str, b: str) -> float:
+    """Token-set (Jaccard) similarity of two prompts, from 0.0 to 1.0."""
+    tokens_a, tokens_b = prompt_tokens(a), prompt_tokens(b)
+    if not tokens_a and not tokens_b:
+        return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+def find_near_duplicate(prompt: str, previous: list[str], threshold: float = PROMPT_DEDUPE_THRESHOLD) -> int | None:
+    """Return the index of the first earlier prompt at least `threshold` similar, or None."""
+    for i, other in enumerate(previous):
+        if prompt_similarity(prompt, other) >= threshold:
+            return i
+    return None
+
+def collapse_prompts(prompts: list[str], threshold: float = PROMPT_DEDUPE_THRESHOLD) -> list[int]:
+    """
+    Map each prompt to the index of the prompt that should be rendered in its place:
+    itself if it is distinct, otherwise the first earlier near-duplicate.
+    """
+    representatives = []
+    for i, prompt in enumerate(prompts):
+        unique = [j for j, r in enumerate(representatives) if r == j]
+        match = find_near_duplicate(prompt, [prompts[j] for j in unique], threshold)
+        representatives.append(i if match is None else unique[match])
+    return representatives
+
+def diversify_prompts(prompts: list[str], threshold: float = PROMPT_DEDUPE_THRESHOLD) -> list[str]:
+    """
+    Rewrite near-duplicate prompts by adding style modifiers not used so far
+    until each one falls below `threshold` similarity to the prompts before it.
+    """
+    diversified = []
+    for prompt in prompts:
+        unused = [s for s in STYLE_VARIATIONS if not any(s in p for p in diversified + [prompt])]
+        random.shuffle(unused)
+        while find_near_duplicate(prompt, diversified, threshold) is not None and unused:
+            prompt = f"{prompt}, {unused.pop()}"
+        diversified.append(prompt)
+    return diversified
+
 # Task 4: Pipelining and Iterating
-def generate_images_from_image(image_url: str, num_images=4):
+DESCRIBE_QUESTION = "Describe this image in detail, including subjects, colors, style, composition, mood, and notable elements."
+
+def usable_description(description: str) -> str:
+    """Replace an empty, failed or degraded VLM description with a placeholder."""
+    if not description or description.startswith("Unable to process") or "unavailable" in description.lower():
+        print("Failed to generate a valid description. Using a placeholder.")
+        return "A placeholder description due to vision model unavailability."
+    return description
+
+# Perceptual hashing: re-encoded, resized or re-tagged copies of an input count as the same image
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', '6'))  # differing bits out of 64
+
+def image_dhash(image_path: str, hash_size: int = 8) -> int:
+    """
+    64-bit difference hash of an image: one bit per horizontally adjacent pixel pair of a
+    (hash_size + 1) x hash_size grayscale thumbnail, set where brightness increases.
+    """
+    with Image.open(image_path) as img:
+        img.draft('L', (hash_size * 4, hash_size * 4))  # lets JPEG decode at reduced scale
+        thumb = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(thumb, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+class HammingIndex:
+    """
+    Multi-index hashing over 64-bit hashes split into 16-bit substrings. Two hashes within
+    max_distance bits differ by at most max_distance // 4 bits on some substring, so a lookup
+    probes each substring table at those few neighbouring keys and only compares full
+    hashes for the entries found there. Values are unique: adding an existing value moves it.
+    """
+    def __init__(self, max_distance: int = PHASH_MAX_DISTANCE, bits: int = 64, chunk_bits: int = 16):
+        self.max_distance = max_distance
+        self._shifts = range(0, bits, chunk_bits)
+        self._mask = (1 << chunk_bits) - 1
+        radius = max_distance // len(self._shifts)
+        self._probes = [sum(1 << bit for bit in flipped) for r in range(radius + 1)
+                        for flipped in itertools.combinations(range(chunk_bits), r)]
+        self._tables = [{} for _ in self._shifts]
+        self._hashes = []
+        self._values = []
+        self._positions = {}  # value -> position in _hashes/_values
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._hashes)
+    
+    def _link(self, position: int, hash_value: int):
+        for table, shift in zip(self._tables, self._shifts):
+            table.setdefault((hash_value >> shift) & self._mask, set()).add(position)
+    
+    def _unlink(self, position: int, hash_value: int):
+        for table, shift in zip(self._tables, self._shifts):
+            key = (hash_value >> shift) & self._mask
+            table[key].discard(position)
+            if not table[key]:
+                del table[key]
+    
+    def _remove(self, value) -> bool:
+        position = self._positions.pop(value, None)
+        if position is None:
+            return False
+        # Move the last entry into the freed slot so positions stay dense
+        last = len(self._hashes) - 1
+        self._unlink(position, self._hashes[position])
+        if position != last:
+            self._unlink(last, self._hashes[last])
+            self._hashes[position], self._values[position] = self._hashes[last], self._values[last]
+            self._positions[self._values[position]] = position
+            self._link(position, self._hashes[position])
+        self._hashes.pop()
+        self._values.pop()
+        return True
+    
+    def add(self, hash_value: int, value):
+        with self._lock:
+            self._remove(value)
+            position = len(self._hashes)
+            self._hashes.append(hash_value)
+            self._values.append(value)
+            self._positions[value] = position
+            self._link(position, hash_value)
+    
+    def remove(self, value) -> bool:
+        """Drop the entry for value; returns False if it was not indexed."""
+        with self._lock:
+            return self._remove(value)
+    
+    def search(self, hash_value: int) -> list[tuple[int, object]]:
+        """Return (distance, value) for every indexed hash within max_distance, closest first."""
+        with self._lock:
+            candidates = set()
+            for table, shift in zip(self._tables, self._shifts):
+                key = (hash_value >> shift) & self._mask
+                for probe in self._probes:
+                    candidates.update(table.get(key ^ probe, ()))
+            matches = [((self._hashes[i] ^ hash_value).bit_count(), i) for i in candidates]
+            return [(distance, self._values[i]) for distance, i in sorted(matches) if distance <= self.max_distance]
+
+# Description and prompts already synthesized for an input image, keyed by content hash;
+# the perceptual index maps near-duplicate inputs onto the same entries
+IMAGE_PROMPT_CACHE_SIZE = int(os.getenv('IMAGE_PROMPT_CACHE_SIZE', '10000'))
+_image_prompt_cache = OrderedDict()
+_image_prompt_cache_lock = threading.Lock()  # service workers remember and look up concurrently
+_image_hash_index = HammingIndex()
+
+def _store_image_prompts(key: str, dhash: int | None, description: str, prompts: list[str]):
+    """Insert into the LRU cache and perceptual index, pruning evicted entries from both."""
+    with _image_prompt_cache_lock:
+        _image_prompt_cache[key] = (description, list(prompts))
+        _image_prompt_cache.move_to_end(key)
+        evicted = []
+        while len(_image_prompt_cache) > IMAGE_PROMPT_CACHE_SIZE:
+            evicted.append(_image_prompt_cache.popitem(last=False)[0])
+    if dhash is not None:
+        _image_hash_index.add(dhash, key)
+    for evicted_key in evicted:
+        _image_hash_index.remove(evicted_key)
+
+def remember_image_prompts(image_path: str, description: str, prompts: list[str], content_hash: str | None = None,
+                           dhash: int | None = None) -> int | None:
+    """Cache the description and prompts for an input image. Returns its dHash, if it could be computed."""
+    if not os.path.isfile(image_path):
+        return None
+    try:
+        key = content_hash or file_sha256(image_path)
+    except OSError as e:
+        print(f"Could not hash {image_path}: {str(e)}")
+        return None
+    if dhash is None:
+        try:
+            dhash = image_dhash(image_path)
+        except Exception as e:
+            print(f"Could not compute perceptual hash of {image_path}: {str(e)}")
+    _store_image_prompts(key, dhash, description, prompts)
+    return dhash
+
+def cached_image_prompts(image_path: str, content_hash: str | None = None) -> tuple[str, list[str]] | None:
+    """Return (description, prompts) from an earlier run on the same or a near-duplicate image, if any."""
+    if not os.path.isfile(image_path):
+        return None
+    try:
+        key = content_hash or file_sha256(image_path)
+    except OSError as e:
+        print(f"Could not hash {image_path}: {str(e)}")
+        return None
+    with _image_prompt_cache_lock:
+        if key in _image_prompt_cache:
+            return _image_prompt_cache[key]
+    if not len(_image_hash_index):
+        return None
+    try:
+        similar = _image_hash_index.search(image_dhash(image_path))
+    except Exception as e:
+        print(f"Could not compute perceptual hash of {image_path}: {str(e)}")
+        return None
+    with _image_prompt_cache_lock:
+        for distance, similar_key in similar:
+            if similar_key in _image_prompt_cache:
+                print(f"{image_path} is a near-duplicate of an earlier input (dHash distance {distance})")
+                return _image_prompt_cache[similar_key]
+    return None
+
+def generate_images_from_image(image_url: str, num_images=4, description: str | None = None,
+                               prompts: list[str] | None = None, stream: bool = False,
+                               mode: str = "txt2img", strength: float = IMG2IMG_STRENGTH,
+                               draft_size: int | None = None, refine_strength: float = 0.0, remember: bool = True):
     """
     Pipeline to generate images from an input image:
-    - Generate a description
-    - Create synthetic prompts
+    - Generate a description (skipped if `description` is given)
+    - Create synthetic prompts (skipped if `prompts` is given)
     - Produce distinct images
+    With stream=True, each prompt is rendered as soon as the LLM emits it.
+    With mode="img2img", the describe and rewrite stages are skipped: variations are
+    denoised from the encoded input image, using cached prompts when available.
+    draft_size and refine_strength select the fast preview render (see generate_images).
+    With PROMPT_DEDUPE_MODE="collapse", near-duplicate prompts are not rendered, so fewer
+    than num_images paths may come back; prompts still lists every synthesized prompt.
+    The description and prompts are cached for near-duplicate inputs unless remember=False
+    or either came from a fallback.
     Returns: (image_paths, prompts, description)
     """
     print(f"Generating images for {image_url}")
     
-    # Step 1: Generate description
-    question = "Describe this image in detail, including subjects, colors, style, composition, mood, and notable elements."
-    original_description = ask_about_image(image_url, question)
-    if not original_description or "unavailable" in original_description.lower():
-        print("Failed to generate a valid description. Using a placeholder.")
-        original_description = "A placeholder description due to vision model unavailability."
-    print(f"Original description: {original_description[:100]}...")
-    
-    # Step 2: Generate synthetic prompts
-    diffusion_prompts = llm_rewrite_to_image_prompts(original_description, num_images)
-    print(f"Generated {len(diffusion_prompts)} prompts:")
-    for i, prompt in enumerate(diffusion_prompts, 1):
-        print(f"  {i}. {prompt}")
-    
-    # Step 3: Generate images
-    images_with_paths = generate_images(diffusion_prompts, n=1)
-    image_paths = [path for _, path in images_with_paths]  # Extract file paths
-    generated_images = [img for img, _ in images_with_paths]  # Extract PIL Images for display
-    
-    if len(image_paths) != num_images:
-        print(f"Warning: Expected {num_images} images, got {len(image_paths)}. Adjusting.")
-        while len(image_paths) < num_images:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            placeholder_path = f"generated_images/placeholder_{timestamp}_{len(image_paths):03d}.png"
+    if mode == "img2img":
+        cached = cached_image_prompts(image_url)
+        if prompts is None and cached:
+            print("Reusing cached description and prompts")
+            description = description or cached[0]
+            prompts = cached[1]
+        original_description = description or ""
+        diffusion_prompts = prompts or [IMG2IMG_DEFAULT_PROMPT]
+        generated_images, image_paths = generate_image_variations(image_url, diffusion_prompts, num_images, strength,
+                                                                  output_type="np")
+        generated_images = list(generated_images)  # views into the batch, not copies
+    else:
+        # Near-duplicates of earlier inputs reuse their description, and their prompts when the count matches
+        if description is None and prompts is None:
+            cached = cached_image_prompts(image_url)
+            if cached:
+                print("Reusing description from an earlier input")
+                description = cached[0]
+                if len(cached[1]) == num_images:
+                    prompts = list(cached[1])
+        
+        # Step 1: Generate description
+        if description is None:
+            description = ask_about_image(image_url, DESCRIBE_QUESTION)
+        original_description = usable_description(description)
+        print(f"Original description: {original_description[:100]}...")
+        # Fallback prompts are rendered but never cached, so later inputs go back to the LLM
+        degraded = False
+    
+        if stream and prompts is None:
+            # Steps 2-3 overlapped: render each prompt while the LLM is still writing the next
+            diffusion_prompts, rendered_prompts, generated_images, image_paths = [], [], [], []
+            
+            def render_streamed(i: int, prompt: str):
+                if PROMPT_DEDUPE_MODE == "diversify":
+                    prompt = diversify_prompts(diffusion_prompts + [prompt])[-1]
+                print(f"  {i + 1}. {prompt}")
+                duplicate = find_near_duplicate(prompt, rendered_prompts) if PROMPT_DEDUPE_MODE == "collapse" else None
+                diffusion_prompts.append(prompt)
+                if duplicate is not None:
+                    print(f"Prompt {i + 1} is a near-duplicate of an already rendered prompt, skipping its render")
+                    return
+                rendered_prompts.append(prompt)
+                batch, paths = generate_images([prompt], n=1, start_index=i, output_type="np",
+                                               draft_size=draft_size, refine_strength=refine_strength)
+                generated_images.extend(batch)
+                image_paths.extend(paths)
+            
+            for i, prompt in enumerate(llm_stream_image_prompts(original_description, num_images, fallback=False)):
+                render_streamed(i, prompt)
+            if len(diffusion_prompts) < num_images:
+                degraded = True
+                for i, prompt in enumerate(create_fallback_prompts(original_description, num_images)[len(diffusion_prompts):],
+                                           len(diffusion_prompts)):
+                    render_streamed(i, prompt)
+        else:
+            # Step 2: Generate synthetic prompts
+            if prompts is None:
+                prompts = llm_rewrite_to_image_prompts(original_description, num_images, fallback=False)
+                if prompts is None:
+                    degraded = True
+                    prompts = create_fallback_prompts(original_description, num_images)
+            diffusion_prompts = diversify_prompts(prompts) if PROMPT_DEDUPE_MODE == "diversify" else prompts
+            print(f"Generated {len(diffusion_prompts)} prompts:")
+            for i, prompt in enumerate(diffusion_prompts, 1):
+                print(f"  {i}. {prompt}")
+        
+            # Step 3: Generate images, skipping prompts that near-duplicate an earlier one
+            batch, image_paths = generate_images(diffusion_prompts, n=1, output_type="np",
+                                                 dedupe="collapse" if PROMPT_DEDUPE_MODE == "collapse" else None,
+                                                 draft_size=draft_size, refine_strength=refine_strength)
+            generated_images = list(batch)  # views into the batch, not copies
+        if remember and original_description == description and not degraded:
+            remember_image_prompts(image_url, original_description, diffusion_prompts)
+
+    
+    expected = num_images
+    if mode != "img2img" and PROMPT_DEDUPE_MODE == "collapse":
+        expected = len(set(collapse_prompts(diffusion_prompts[:num_images]))) + max(0, num_images - len(diffusion_prompts))
+    if len(image_paths) != expected:
+        print(f"Warning: Expected {expected} images, got {len(image_paths)}. Adjusting.")
+        while len(image_paths) < expected:
+            placeholder_path = f"generated_images/placeholder_{output_stamp()}_{len(image_paths):03d}.png"
             image_paths.append(placeholder_path)
-            generated_images.append(Image.new('RGB', (512, 512), color='lightgray'))
+            generated_images.append(placeholder_batch(1)[0])
     
-    # Step 4: Display images and print file paths
+    # Step 4: Write a contact sheet and print file paths
     if generated_images:
         print("Generated image file paths:")
-        for i, path in enumerate(image_paths[:4], 1):
+        for i, path in enumerate(image_paths, 1):
             print(f"  Image {i}: {path}")
         
-        fig, axes = plt.subplots(2, 2, figsize=(10, 10))
-        axes = axes.flatten()
-        for i, img in enumerate(generated_images[:4]):
-            axes[i].imshow(img)
-            axes[i].axis('off')
-            axes[i].set_title(f"Image {i+1}")
-        for i in range(len(generated_images), 4):
-            axes[i].axis('off')
-        plt.tight_layout()
-        plt.show()
+        sheet_path = build_contact_sheet(generated_images, f"generated_images/contact_sheet_{output_stamp()}.png", cols=2)
+        print(f"Contact sheet: {sheet_path}")
     else:
         print("No images were successfully generated")
     
     return image_paths, diffusion_prompts, original_description
 
-# Execute the pipeline
-if __name__ == "__main__":
+def generate_images_from_images(image_urls: list[str], num_images=4, batch_size: int = 4,
+                                mode: str = "txt2img", strength: float = IMG2IMG_STRENGTH,
+                                draft_size: int | None = None, refine_strength: float = 0.0):
+    """
+    Run the pipeline over several input images, describing them through the
+    micro-batcher and synthesizing all prompts with batched LLM requests.
+    Returns a list of (image_paths, prompts, description), one per input image.
+    """
+    if mode == "img2img":
+        return [generate_images_from_image(url, num_images, mode=mode, strength=strength) for url in image_urls]
+    raw_descriptions = describe_images(image_urls, DESCRIBE_QUESTION)
+    descriptions = [usable_description(d) for d in raw_descriptions]
+    prompt_lists = llm_rewrite_many_to_image_prompts(descriptions, num_images, batch_size, fallback=False)
     results = []
-    for img in ["imgs/agent-overview.png", "imgs/multimodal.png", "img-files/tree-frog.jpg", "img-files/paint-cat.jpg"]:
-        if os.path.exists(img):
-            results.append(generate_images_from_image(img))
+    for image_url, raw, description, prompts in zip(image_urls, raw_descriptions, descriptions, prompt_lists):
+        # Placeholder descriptions and fallback prompts are used for this run only
+        degraded = prompts is None or description != raw
+        if prompts is None:
+            prompts = create_fallback_prompts(description, num_images)
+        results.append(generate_images_from_image(image_url, num_images, description=description, prompts=prompts,
+                                                  draft_size=draft_size, refine_strength=refine_strength,
+                                                  remember=not degraded))
+    return results
+
+# Resumable corpus processing
+CORPUS_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif')
+
+def corpus_inputs(source: str) -> list[str]:
+    """Expand a directory (recursively) or a glob pattern into a sorted list of image files."""
+    if os.path.isdir(source):
+        source = os.path.join(source, "**", "*")
+    return sorted(
+        path for path in glob.glob(source, recursive=True)
+        if os.path.isfile(path) and path.lower().endswith(CORPUS_IMAGE_EXTENSIONS)
+    )
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def corpus_config(num_images: int) -> dict:
+    """Settings that change the outputs; a change invalidates existing checkpoints."""
+    return {
+        "question": DESCRIBE_QUESTION,
+        "rewrite_template": REWRITE_PROMPT_TEMPLATE,
+        "batch_rewrite_template": BATCH_REWRITE_PROMPT_TEMPLATE,
+        "batch_prompts_schema": BATCH_PROMPTS_SCHEMA,
+        "diffusion_model": DIFFUSION_MODEL_ID,
+        "num_images": num_images,
+        "dedupe": PROMPT_DEDUPE_MODE,
+        "dedupe_threshold": PROMPT_DEDUPE_THRESHOLD
+    }
+
+class CorpusState:
+    """
+    SQLite store of per-image stage checkpoints (description, prompts, rendered outputs)
+    and the image's dHash, keyed by image content hash and config hash. Every stage is committed as soon as it
+    completes, so a crashed run loses at most the stage that was in progress.
+    """
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                content_hash TEXT NOT NULL,
+                config_hash TEXT NOT NULL,
+                source_path TEXT,
+                description TEXT,
+                prompts TEXT,
+                outputs TEXT,
+                dhash TEXT,
+                updated_at TEXT,
+                PRIMARY KEY (content_hash, config_hash)
+            )
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(checkpoints)")}
+        if "dhash" not in columns:  # state files written before dHashes were checkpointed
+            self._conn.execute("ALTER TABLE checkpoints ADD COLUMN dhash TEXT")
+        self._conn.commit()
+        self._lock = threading.Lock()
+    
+    def load(self, content_hash: str, config_hash: str) -> dict:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT description, prompts, outputs, dhash FROM checkpoints WHERE content_hash = ? AND config_hash = ?",
+                (content_hash, config_hash)
+            ).fetchone()
+        if row is None:
+            return {}
+        description, prompts, outputs, dhash = row
+        return {
+            "description": description,
+            "prompts": json.loads(prompts) if prompts else None,
+            "outputs": json.loads(outputs) if outputs else None,
+            "dhash": int(dhash, 16) if dhash else None
+        }
+    
+    def remembered(self, config_hash: str):
+        """Yield (content_hash, dhash, description, prompts) for checkpoints with all three, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT content_hash, dhash, description, prompts FROM checkpoints
+                   WHERE config_hash = ? AND dhash IS NOT NULL AND description IS NOT NULL AND prompts IS NOT NULL
+                   ORDER BY updated_at""",
+                (config_hash,)
+            ).fetchall()
+        for content_hash, dhash, description, prompts in rows:
+            yield content_hash, int(dhash, 16), description, json.loads(prompts)
+    
+    def save(self, content_hash: str, config_hash: str, source_path: str, stage: str, value):
+        assert stage in ("description", "prompts", "outputs", "dhash"), f"Unknown stage {stage}"
+        if stage == "dhash":
+            stored = f"{value:016x}"  # 64-bit unsigned does not fit SQLite's signed INTEGER
         else:
-            print(f"Image {img} not found")
+            stored = value if stage == "description" else json.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                f"""INSERT INTO checkpoints (content_hash, config_hash, source_path, {stage}, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (content_hash, config_hash)
+                    DO UPDATE SET source_path = excluded.source_path, {stage} = excluded.{stage},
+                                  updated_at = excluded.updated_at""",
+                (content_hash, config_hash, source_path, stored, datetime.now().isoformat(timespec="seconds"))
+            )
+            self._conn.commit()
+    
+    def close(self):
+        self._conn.close()
+
+def run_corpus(source: str, state_path: str = "corpus_state.sqlite", num_images: int = 4,
+               output_root: str = "generated_images/corpus", chunk_size: int = 8) -> dict:
+    """
+    Process every image under `source` (a directory or glob), resuming from checkpoints.
+    Inputs whose content hash and config already have rendered outputs on disk are skipped;
+    others continue from their last completed stage. Images are handled in chunks so the
+    describe and rewrite stages can use the batched VLM and LLM paths.
+    Inputs whose description or prompts came from a fallback are rendered but not checkpointed,
+    so a later run retries them.
+    Returns counts of processed, degraded, skipped and failed inputs.
+    """
+    config_hash = hashlib.sha256(json.dumps(corpus_config(num_images), sort_keys=True).encode()).hexdigest()
+    state = CorpusState(state_path)
+    paths = corpus_inputs(source)
+    print(f"Found {len(paths)} images in {source}")
+    counts = {"processed": 0, "degraded": 0, "skipped": 0, "failed": 0}
+    
+    # Rebuild the near-duplicate cache from earlier runs, so a re-encoded copy of an input
+    # processed in any previous run reuses its description and prompts
+    restored = 0
+    for content_hash, dhash, description, prompts in state.remembered(config_hash):
+        _store_image_prompts(content_hash, dhash, description, prompts)
+        restored += 1
+    if restored:
+        print(f"Restored {restored} checkpointed descriptions into the near-duplicate index")
+    
+    try:
+        for start in range(0, len(paths), chunk_size):
+            pending = []
+            for path in paths[start:start + chunk_size]:
+                content_hash = file_sha256(path)
+                checkpoint = state.load(content_hash, config_hash)
+                if checkpoint.get("description") and usable_description(checkpoint["description"]) != checkpoint["description"]:
+                    checkpoint = {}  # checkpointed from a failed describe call; redo every stage
+                outputs = checkpoint.get("outputs")
+                if outputs and all(os.path.exists(p) for p in outputs):
+                    counts["skipped"] += 1
+                    continue
+                pending.append((path, content_hash, checkpoint))
+            if not pending:
+                continue
+            
+            # Near-duplicates of inputs processed earlier reuse their description and prompts
+            for path, content_hash, checkpoint in pending:
+                cached = None if checkpoint.get("description") else cached_image_prompts(path, content_hash)
+                if cached:
+                    checkpoint["description"] = cached[0]
+                    state.save(content_hash, config_hash, path, "description", cached[0])
+                    if len(cached[1]) == num_images:
+                        checkpoint["prompts"] = list(cached[1])
+                        state.save(content_hash, config_hash, path, "prompts", checkpoint["prompts"])
+            
+            # Stage 1: describe images that have no checkpointed description
+            needs_description = [item for item in pending if not item[2].get("description")]
+            degraded = set()
+            if needs_description:
+                # Within the chunk, only the first of each group of near-duplicates is described
+                chunk_index, representatives = HammingIndex(), []
+                for k, (path, _, _) in enumerate(needs_description):
+                    try:
+                        dhash = image_dhash(path)
+                    except Exception:
+                        representatives.append(k)
+                        continue
+                    similar = chunk_index.search(dhash)
+                    representatives.append(similar[0][1] if similar else k)
+                    if not similar:
+                        chunk_index.add(dhash, k)
+                unique = sorted(set(representatives))
+                described = dict(zip(unique, describe_images([needs_description[k][0] for k in unique], DESCRIBE_QUESTION)))
+                descriptions = [described[k] for k in representatives]
+                for (path, content_hash, checkpoint), description in zip(needs_description, descriptions):
+                    checkpoint["description"] = usable_description(description)
+                    # Degraded descriptions are used for this run but not checkpointed, so a later run retries them
+                    if checkpoint["description"] == description:
+                        state.save(content_hash, config_hash, path, "description", description)
+                    else:
+                        degraded.add(content_hash)
+            
+            # Stage 2: synthesize prompts for images that have no checkpointed prompts
+            needs_prompts = [item for item in pending if not item[2].get("prompts")]
+            if needs_prompts:
+                descriptions = list(dict.fromkeys(c["description"] for _, _, c in needs_prompts))
+                prompt_lists = dict(zip(descriptions, llm_rewrite_many_to_image_prompts(descriptions, num_images, fallback=False)))
+                for path, content_hash, checkpoint in needs_prompts:
+                    prompts = prompt_lists[checkpoint["description"]]
+                    if prompts is None:
+                        degraded.add(content_hash)
+                        prompts = create_fallback_prompts(checkpoint["description"], num_images)
+                    checkpoint["prompts"] = prompts
+                    # Prompts built on a placeholder description are as degraded as the description
+                    if content_hash not in degraded:
+                        state.save(content_hash, config_hash, path, "prompts", prompts)
+            for path, content_hash, checkpoint in pending:
+                if content_hash not in degraded:
+                    dhash = remember_image_prompts(path, checkpoint["description"], checkpoint["prompts"],
+                                                   content_hash, checkpoint.get("dhash"))
+                    if dhash is not None and checkpoint.get("dhash") is None:
+                        state.save(content_hash, config_hash, path, "dhash", dhash)
+            
+            # Stage 3: render, one output directory per input so names never collide
+            for path, content_hash, checkpoint in pending:
+                try:
+                    print(f"Rendering {num_images} images for {path}")
+                    _, outputs = generate_images(
+                        checkpoint["prompts"], n=1, output_dir=os.path.join(output_root, content_hash[:16]),
+                        dedupe=None if PROMPT_DEDUPE_MODE == "off" else PROMPT_DEDUPE_MODE, output_type="np"
+                    )
+                    # generate_images reports render errors as placeholder paths that are never written
+                    missing = [p for p in outputs if not os.path.isfile(p)]
+                    if missing:
+                        raise RuntimeError(f"{len(missing)} of {len(outputs)} outputs were not rendered")
+                    if content_hash in degraded:
+                        print(f"Not checkpointing outputs for {path}: they were built on fallback description or prompts")
+                        counts["degraded"] += 1
+                        continue
+                    state.save(content_hash, config_hash, path, "outputs", outputs)
+                    counts["processed"] += 1
+                except Exception as e:
+                    print(f"Failed to render {path}: {str(e)}")
+                    counts["failed"] += 1
+    finally:
+        state.close()
+    
+    print(f"Corpus run complete: {counts['processed']} processed, {counts['degraded']} degraded, "
+          f"{counts['skipped']} skipped, {counts['failed']} failed")
+    return counts
+
+# Benchmarking: local stub model server + tiny diffusion model
+STUB_DESCRIPTION = ("A stub description of a brightly lit scene with a detailed subject, "
+                    "vibrant colors, soft shadows and a clean composition.")
+
+def stub_completion_text(messages: list[dict]) -> str:
+    """Produce a plausible completion for the describe, rewrite and batched rewrite requests."""
+    content = messages[-1]["content"]
+    if isinstance(content, list):
+        image_count = sum(1 for part in content if part.get("type") == "image_url")
+        return json.dumps([STUB_DESCRIPTION] * image_count) if image_count > 1 else STUB_DESCRIPTION
+    
+    match = re.search(r'create (\d+) different', content, re.IGNORECASE)
+    n = int(match.group(1)) if match else 4
+    styles = ["watercolor", "oil painting", "studio photo", "pencil sketch", "neon cyberpunk", "isometric render"]
+    if "JSON schema" in content:
+        ids = sorted({int(i) for i in re.findall(r'"id": (\d+)', content)})
+        return json.dumps({"results": [
+            {"id": i, "prompts": [f"{styles[j % len(styles)]} of subject {i}, view {j + 1}, high quality" for j in range(n)]}
+            for i in ids
+        ]})
+    return "\n".join(f"{j + 1}. {styles[j % len(styles)]} of the scene, view {j + 1}, high quality, detailed"
+                     for j in range(n))
+
+class _StubModelHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+    
+    def _send_json(self, status: int, body: dict, headers: dict | None = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_GET(self):
+        if self.path.rstrip('/').endswith("/models"):
+            models = ["meta/llama-3.2-11b-vision-instruct", "meta/llama-3.3-70b-instruct"]
+            self._send_json(200, {"object": "list", "data": [{"id": m, "object": "model"} for m in models]})
+        else:
+            self._send_json(404, {"error": "not found"})
+    
+    def do_POST(self):
+        stub = self.server.stub
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(stub.latency)
+        if random.random() < stub.error_rate:
+            self._send_json(503, {"status": 503, "title": "Service Unavailable"}, {"Retry-After": "0"})
+            return
+        
+        text = stub_completion_text(payload.get("messages", [{"content": ""}]))
+        if not payload.get("stream"):
+            self._send_json(200, {
+                "id": "stub", "object": "chat.completion", "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]
+            })
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for piece in re.findall(r'\S+\s*', text):
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "model": payload.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(stub.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+class StubModelServer:
+    """
+    Local OpenAI-compatible chat completions server standing in for NVIDIA_BASE_URL.
+    Each request waits `latency` seconds (plus `token_latency` per streamed token)
+    and a fraction `error_rate` of requests fail with 503.
+    """
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, token_latency: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_latency = token_latency
+        self._server = ThreadingHTTPServer((host, port), _StubModelHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+    
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+    
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+    
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def build_tiny_diffusion_pipeline(seed: int = 0):
+    """
+    Build a tiny, randomly initialized Stable Diffusion pipeline that runs on CPU.
+    The output is noise, but every stage (tokenizer, text encoder, UNet, scheduler,
+    VAE) does real work, so relative timings and memory behavior are meaningful.
+    """
+    torch.manual_seed(seed)
+    
+    # Byte-level CLIP vocabulary without merges: every character is its own token
+    byte_chars = [chr(c) for c in range(ord('!'), ord('~') + 1)]
+    byte_chars += [chr(c) for c in range(ord('¡'), ord('¬') + 1)] + [chr(c) for c in range(ord('®'), ord('ÿ') + 1)]
+    byte_chars += [chr(256 + i) for i in range(256 - len(byte_chars))]
+    tokens = ["<|startoftext|>", "<|endoftext|>"] + byte_chars + [c + "</w>" for c in byte_chars]
+    vocab = {token: i for i, token in enumerate(tokens)}
+    with tempfile.TemporaryDirectory() as tokenizer_dir:
+        with open(os.path.join(tokenizer_dir, "vocab.json"), "w") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(tokenizer_dir, "merges.txt"), "w") as f:
+            f.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer.from_pretrained(tokenizer_dir, model_max_length=77)
+    
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(vocab), hidden_size=32, intermediate_size=37, num_hidden_layers=2,
+        num_attention_heads=4, max_position_embeddings=77, bos_token_id=vocab["<|startoftext|>"],
+        eos_token_id=vocab["<|endoftext|>"], pad_token_id=vocab["<|endoftext|>"]
+    ))
+    unet = UNet2DConditionModel(
+        sample_size=64, in_channels=4, out_channels=4, layers_per_block=1,
+        block_out_channels=(32, 64), cross_attention_dim=32, attention_head_dim=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D")
+    )
+    # Four VAE blocks keep the usual 8x latent downscaling of Stable Diffusion
+    vae = AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=4, block_out_channels=(16, 16, 16, 16),
+        layers_per_block=1, norm_num_groups=8, sample_size=512,
+        down_block_types=("DownEncoderBlock2D",) * 4, up_block_types=("UpDecoderBlock2D",) * 4
+    )
+    pipeline = StableDiffusionPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet,
+        scheduler=DPMSolverMultistepScheduler(steps_offset=1), safety_checker=None,
+        feature_extractor=None, requires_safety_checker=False
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def current_rss_mb() -> float:
+    """Current resident set size of this process in MB (falls back to the peak off Linux)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+class PeakRSSSampler:
+    """
+    Context manager that samples RSS in a background thread to find the peak of one
+    block of code, which ru_maxrss (a process-lifetime peak) cannot report.
+    """
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.baseline_mb = self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+    
+    def __enter__(self):
+        gc.collect()
+        self.baseline_mb = self.peak_mb = current_rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+    
+    @property
+    def delta_mb(self) -> float:
+        return self.peak_mb - self.baseline_mb
+
+def run_resolution_sweep(resolutions: list[int] = (512, 768, 1024), num_inference_steps: int = 20,
+                         output_dir: str = "benchmarks") -> dict:
+    """
+    Measure render latency and peak RSS against resolution with the tiny pipeline,
+    rendering each size both in one pass and tiled, and save the table as JSON.
+    """
+    pipeline = build_tiny_diffusion_pipeline()
+    prompt = "a lighthouse on a cliff at sunset, high quality, detailed"
+    rows = []
+    for size in resolutions:
+        for tiled in (False, True):
+            generator = torch.Generator(device="cpu").manual_seed(42)
+            with PeakRSSSampler() as sampler:
+                started = time.perf_counter()
+                if tiled:
+                    render_tiled(pipeline, "cpu", prompt, size, size, generator, num_inference_steps)
+                else:
+                    pipeline(prompt, num_inference_steps=num_inference_steps, width=size, height=size,
+                             generator=generator)
+                elapsed = time.perf_counter() - started
+            rows.append({"resolution": size, "tiled": tiled, "latency_s": elapsed,
+                         "peak_rss_mb": sampler.peak_mb, "peak_rss_delta_mb": sampler.delta_mb})
+            print(f"{size:>5}px {'tiled' if tiled else 'full':>5}: {elapsed:7.2f} s, "
+                  f"peak RSS {sampler.peak_mb:7.0f} MB (+{sampler.delta_mb:.0f} MB)")
+    
+    results = {"commit": git_commit(), "timestamp": datetime.now().isoformat(timespec="seconds"),
+               "config": {"num_inference_steps": num_inference_steps, "tile_size": HIGH_RES_TILE_SIZE,
+                          "tile_overlap": HIGH_RES_TILE_OVERLAP, "model": "tiny-random-sd", "device": "cpu"},
+               "resolutions": rows}
+    os.makedirs(output_dir, exist_ok=True)
+    results_path = os.path.join(output_dir, f"resolution_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['commit']}.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved resolution sweep to: {results_path}")
+    return results
+
+# Autotuning: time a small matrix of render settings on this machine and persist the fastest
+SD_PARAMETER_COUNT = 1.07e9  # UNet, VAE and CLIP text encoder of Stable Diffusion 1.5
+AUTOTUNE_BATCH_SIZES = (1, 2, 4)
+
+def autotune_render_settings(resolution: int = 256, num_inference_steps: int = 4, repeats: int = 2,
+                             profile_path: str = RENDER_PROFILE_PATH, output_dir: str = "benchmarks") -> dict:
+    """
+    Time every combination of dtype, attention mode, thread count and batch size with the
+    tiny pipeline, then write the fastest per image whose estimated footprint for the full
+    model at 512x512 fits in free memory to the render profile. Returns the profile.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        dtypes = ["float16", "float32"] + (["bfloat16"] if torch.cuda.is_bf16_supported() else [])
+        thread_counts = [torch.get_num_threads()]
+    else:
+        dtypes = ["float32", "bfloat16"]
+        thread_counts = sorted({1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1})
+    budget = available_memory_mb(device) * MEMORY_HEADROOM
+    prompt = "a lighthouse on a cliff at sunset, high quality, detailed"
+    default_threads = torch.get_num_threads()
+    rows = []
+    print(f"Autotuning on {device}: {len(dtypes)} dtypes x 2 attention modes x {len(thread_counts)} thread counts "
+          f"x {len(AUTOTUNE_BATCH_SIZES)} batch sizes, {budget:.0f} MB budget")
+    try:
+        for dtype_name in dtypes:
+            pipeline = build_tiny_diffusion_pipeline().to(device=device, dtype=getattr(torch, dtype_name))
+            weights_mb = SD_PARAMETER_COUNT * getattr(torch, dtype_name).itemsize / (1024 * 1024)
+            for mode in ("full", "sliced"):
+                if mode == "sliced":
+                    pipeline.enable_attention_slicing("max")
+                else:
+                    pipeline.disable_attention_slicing()
+                for threads in thread_counts:
+                    torch.set_num_threads(threads)
+                    for batch_size in AUTOTUNE_BATCH_SIZES:
+                        footprint = weights_mb + estimate_render_memory_mb(pipeline, 512, 512, batch_size)[mode]
+                        row = {"dtype": dtype_name, "memory_mode": mode, "threads": threads, "batch_size": batch_size,
+                               "estimated_mb": round(footprint), "fits": footprint <= budget, "s_per_image": None}
+                        try:
+                            def render():
+                                generators = [torch.Generator(device=device).manual_seed(k) for k in range(batch_size)]
+                                pipeline([prompt] * batch_size, num_inference_steps=num_inference_steps, width=resolution,
+                                         height=resolution, generator=generators, output_type="np")
+                            render()  # warm-up
+                            started = time.perf_counter()
+                            for _ in range(repeats):
+                                render()
+                            row["s_per_image"] = (time.perf_counter() - started) / (repeats * batch_size)
+                            print(f"{dtype_name:>9} {mode:>6} threads={threads:<3} batch={batch_size}: "
+                                  f"{row['s_per_image'] * 1000:8.1f} ms/image, ~{footprint:.0f} MB"
+                                  f"{'' if row['fits'] else ' (does not fit)'}")
+                        except Exception as e:
+                            print(f"{dtype_name:>9} {mode:>6} threads={threads:<3} batch={batch_size}: failed ({str(e)})")
+                        rows.append(row)
+            del pipeline
+            gc.collect()
+    finally:
+        torch.set_num_threads(default_threads)
+    
+    measured = [row for row in rows if row["s_per_image"] is not None]
+    if not measured:
+        raise RuntimeError("No configuration could render; no profile written")
+    fitting = [row for row in measured if row["fits"]]
+    best = min(fitting, key=lambda row: row["s_per_image"]) if fitting else min(measured, key=lambda row: row["estimated_mb"])
+    settings = {"dtype": best["dtype"], "memory_mode": best["memory_mode"], "batch_size": best["batch_size"],
+                "autocast": False}
+    if device == "cpu":
+        settings["threads"] = best["threads"]
+    
+    profile = {"machine": machine_fingerprint(), "settings": settings, "commit": git_commit(),
+               "timestamp": datetime.now().isoformat(timespec="seconds"),
+               "config": {"resolution": resolution, "num_inference_steps": num_inference_steps, "repeats": repeats,
+                          "model": "tiny-random-sd", "budget_mb": round(budget)},
+               "results": rows}
+    os.makedirs(os.path.dirname(profile_path) or ".", exist_ok=True)
+    with open(profile_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(f"Best: {settings} ({best['s_per_image'] * 1000:.1f} ms/image)")
+    print(f"Saved render profile to: {profile_path}")
+    render_profile.clear()
+    render_profile.update(settings)
+    return profile
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+def summarize_latencies(latencies: list[float]) -> dict:
+    return {
+        "count": len(latencies),
+        "mean_s": sum(latencies) / len(latencies),
+        "p50_s": percentile(latencies, 50),
+        "p90_s": percentile(latencies, 90),
+        "p99_s": percentile(latencies, 99),
+        "throughput_per_s": len(latencies) / sum(latencies) if sum(latencies) else 0.0
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def run_benchmark(image_paths: list[str] | None = None, iterations: int = 5, num_images: int = 2,
+                  latency: float = 0.05, error_rate: float = 0.0, output_dir: str = "benchmarks",
+                  baseline_path: str | None = None) -> dict:
+    """
+    Benchmark each pipeline stage against a local stub model server and a tiny diffusion model.
+    Reports latency percentiles, throughput and peak RSS per stage (sampled around each
+    stage call, so one stage's peak does not leak into the next), and saves the results
+    as JSON under output_dir; pass a saved result as baseline_path to compare commits.
+    """
+    work_dir = tempfile.mkdtemp(prefix="bench_inputs_")
+    if not image_paths:
+        image_paths = []
+        for i in range(iterations):
+            path = os.path.join(work_dir, f"input_{i:03d}.png")
+            Image.merge('RGB', [Image.effect_noise((640, 480), 64) for _ in range(3)]).save(path)
+            image_paths.append(path)
+    image_paths = image_paths[:iterations]
+    
+    previous_base_url = os.environ.get('NVIDIA_BASE_URL')
+    stages = {"describe": [], "rewrite": [], "render": [], "pipeline": []}
+    peaks = {name: {"peak_rss_mb": 0.0, "peak_rss_delta_mb": 0.0} for name in stages}
+    
+    def timed(stage, fn, *args, **kwargs):
+        with PeakRSSSampler() as sampler:
+            t0 = time.perf_counter()
+            result = fn(*args, **kwargs)
+            stages[stage].append(time.perf_counter() - t0)
+        peaks[stage]["peak_rss_mb"] = max(peaks[stage]["peak_rss_mb"], sampler.peak_mb)
+        peaks[stage]["peak_rss_delta_mb"] = max(peaks[stage]["peak_rss_delta_mb"], sampler.delta_mb)
+        return result
+    
+    started = time.perf_counter()
+    with StubModelServer(latency=latency, error_rate=error_rate) as stub:
+        os.environ['NVIDIA_BASE_URL'] = stub.base_url
+        with _pipelines_lock:
+            _pipelines[DIFFUSION_MODEL_ID] = (build_tiny_diffusion_pipeline(), "cpu")
+        try:
+            for image_path in image_paths:
+                description = timed("describe", ask_about_image, image_path, DESCRIBE_QUESTION)
+                prompts = timed("rewrite", llm_rewrite_to_image_prompts, description, num_images)
+                timed("render", generate_images, prompts, output_type="np")
+            for image_path in image_paths:
+                timed("pipeline", generate_images_from_image, image_path, num_images)
+        finally:
+            release_diffusion_pipelines()
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if previous_base_url is None:
+                os.environ.pop('NVIDIA_BASE_URL', None)
+            else:
+                os.environ['NVIDIA_BASE_URL'] = previous_base_url
+    
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {"iterations": len(image_paths), "num_images": num_images, "latency": latency,
+                   "error_rate": error_rate, "model": "tiny-random-sd", "device": "cpu"},
+        "stages": {name: summarize_latencies(values) for name, values in stages.items() if values},
+        "images_per_s": len(image_paths) * num_images / sum(stages["pipeline"]) if stages["pipeline"] else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "wall_time_s": time.perf_counter() - started
+    }
+    for name, peak in peaks.items():
+        if name in results["stages"]:
+            results["stages"][name].update(peak)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    results_path = os.path.join(output_dir, f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['commit']}.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        print(f"Baseline: {baseline_path} ({baseline['commit']})")
+    print_benchmark(results, baseline)
+    print(f"Saved benchmark results to: {results_path}")
+    return results
+
+def print_benchmark(results: dict, baseline: dict | None = None):
+    print(f"\nBenchmark @ {results['commit']} ({results['config']})")
+    print(f"{'stage':<10} {'n':>4} {'p50 s':>9} {'p90 s':>9} {'p99 s':>9} {'ops/s':>8} {'+RSS MB':>8}"
+          + ("  p50 vs base" if baseline else ""))
+    for name, stats in results["stages"].items():
+        line = (f"{name:<10} {stats['count']:>4} {stats['p50_s']:>9.4f} {stats['p90_s']:>9.4f} "
+                f"{stats['p99_s']:>9.4f} {stats['throughput_per_s']:>8.2f} {stats.get('peak_rss_delta_mb', 0):>8.0f}")
+        base = (baseline or {}).get("stages", {}).get(name)
+        if base and base["p50_s"]:
+            line += f"  {(stats['p50_s'] - base['p50_s']) / base['p50_s']:+.1%}"
+        print(line)
+    print(f"images/s: {results['images_per_s']:.3f}   peak RSS: {results['peak_rss_mb']:.0f} MB")
+
+# Local HTTP service: pipelines and LLM clients stay warm across requests
+SERVICE_CONCURRENCY = int(os.getenv('SERVICE_CONCURRENCY', '2'))  # requests executing at once
+SERVICE_QUEUE_SIZE = int(os.getenv('SERVICE_QUEUE_SIZE', '16'))  # requests waiting for a slot; more get 503
+SERVICE_DRAIN_TIMEOUT = float(os.getenv('SERVICE_DRAIN_TIMEOUT', '120'))  # seconds to finish in-flight work on shutdown
+SERVICE_MAX_BODY = 1 << 20
+
+def _required(payload: dict, field: str):
+    if not payload.get(field):
+        raise ValueError(f"missing required field '{field}'")
+    return payload[field]
+
+def _existing_image(payload: dict) -> str:
+    image_path = _required(payload, "image")
+    if not os.path.isfile(image_path):
+        raise ValueError(f"image not found: {image_path}")
+    return image_path
+
+def _rendered(image_paths: list[str]) -> list[str]:
+    """Fail the request if any output is a placeholder that was never written (the render failed)."""
+    missing = [path for path in image_paths if not os.path.isfile(path)]
+    if missing:
+        raise RuntimeError(f"{len(missing)} of {len(image_paths)} images failed to render")
+    return image_paths
+
+def service_describe(payload: dict) -> dict:
+    return {"description": ask_about_image(_existing_image(payload), payload.get("question", DESCRIBE_QUESTION))}
+
+def service_rewrite(payload: dict) -> dict:
+    return {"prompts": llm_rewrite_to_image_prompts(_required(payload, "description"), int(payload.get("n", 4)))}
+
+def service_render(payload: dict) -> dict:
+    prompts = _required(payload, "prompts")
+    if not isinstance(prompts, list) or not all(isinstance(p, str) for p in prompts):
+        raise ValueError("'prompts' must be a list of strings")
+    width, height = int(payload.get("width", 512)), int(payload.get("height", 512))
+    draft_size = int(payload["draft_size"]) if payload.get("draft_size") else None
+    refine_strength = float(payload.get("refine_strength", 0.0))
+    validate_render_options(width, height, draft_size, refine_strength)
+    _, image_paths = generate_images(prompts, coalesce=True, output_type="np",
+                                     dedupe="collapse" if PROMPT_DEDUPE_MODE == "collapse" else None,
+                                     width=width, height=height, draft_size=draft_size, refine_strength=refine_strength)
+    return {"image_paths": _rendered(image_paths)}
+
+def service_pipeline(payload: dict) -> dict:
+    draft_size = int(payload["draft_size"]) if payload.get("draft_size") else None
+    refine_strength = float(payload.get("refine_strength", 0.0))
+    validate_render_options(512, 512, draft_size, refine_strength)  # the pipeline renders at 512x512
+    image_paths, prompts, description = generate_images_from_image(
+        _existing_image(payload), int(payload.get("num_images", 4)),
+        description=payload.get("description"), prompts=payload.get("prompts"),
+        mode=payload.get("mode", "txt2img"), strength=float(payload.get("strength", IMG2IMG_STRENGTH)),
+        draft_size=draft_size, refine_strength=refine_strength
+    )
+    return {"image_paths": _rendered(image_paths), "prompts": prompts, "description": description}
+
+SERVICE_ROUTES = {
+    "/describe": service_describe,
+    "/rewrite": service_rewrite,
+    "/render": service_render,
+    "/pipeline": service_pipeline,
+}
+
+class PipelineService:
+    """
+    asyncio HTTP front end for the pipeline stages (POST /describe, /rewrite, /render,
+    /pipeline with a JSON body; GET /health). Models are loaded once before the port opens.
+    Up to `concurrency` requests run on worker threads and `queue_size` more wait for a
+    slot; beyond that requests get 503 instead of piling up. SIGTERM/SIGINT stop accepting
+    connections and wait up to `drain_timeout` seconds for in-flight requests.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 8000, concurrency: int = SERVICE_CONCURRENCY,
+                 queue_size: int = SERVICE_QUEUE_SIZE, drain_timeout: float = SERVICE_DRAIN_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.drain_timeout = drain_timeout
+        self.ready = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="service")
+        self._running = 0
+        self._waiting = 0
+        self._connections = set()
+        self._loop = None
+        self._slots = None
+        self._stopping = None
+    
+    def warm_up(self):
+        start = time.perf_counter()
+        get_img2img_pipeline()
+        build_rewrite_chain()
+        for model in ["meta/llama-3.2-11b-vision-instruct", "meta/llama-3.3-70b-instruct"]:
+            try:
+                get_chat_model(model, max_tokens=1000, temperature=0.1)
+            except Exception as e:
+                print(f"Could not warm up {model}: {str(e)}")
+        print(f"Warm-up finished in {time.perf_counter() - start:.1f}s")
+    
+    async def _dispatch(self, method: str, path: str, body: bytes) -> tuple[int, dict, dict]:
+        if method == "GET" and path == "/health":
+            status = "draining" if self._stopping.is_set() else "ok"
+            return 200, {"status": status, "running": self._running, "waiting": self._waiting}, {}
+        handler = SERVICE_ROUTES.get(path)
+        if handler is None:
+            return 404, {"error": f"unknown endpoint {path}"}, {}
+        if method != "POST":
+            return 405, {"error": "use POST"}, {"Allow": "POST"}
+        if self._stopping.is_set():
+            return 503, {"error": "shutting down"}, {}
+        if self._running + self._waiting >= self.concurrency + self.queue_size:
+            return 503, {"error": "queue full"}, {"Retry-After": "1"}
+        try:
+            payload = json.loads(body or b"{}")
+            if not isinstance(payload, dict):
+                raise ValueError("body must be a JSON object")
+        except ValueError as e:
+            return 400, {"error": f"invalid JSON body: {str(e)}"}, {}
+        
+        received = time.perf_counter()
+        self._waiting += 1
+        try:
+            async with self._slots:
+                self._waiting -= 1
+                self._running += 1
+                started = time.perf_counter()
+                try:
+                    result = await self._loop.run_in_executor(self._executor, handler, payload)
+                finally:
+                    self._running -= 1
+        except ValueError as e:
+            return 400, {"error": str(e)}, {}
+        except Exception as e:
+            print(f"Error in {path}: {str(e)}")
+            return 500, {"error": str(e)}, {}
+        result["queued_seconds"] = round(started - received, 3)
+        result["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+        print(f"{path}: {result['elapsed_seconds']:.2f}s (queued {result['queued_seconds']:.2f}s)")
+        return 200, result, {}
+    
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(asyncio.current_task())
+        try:
+            try:
+                method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > SERVICE_MAX_BODY:
+                    status, body, extra_headers = 413, {"error": "request body too large"}, {}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    path = target.split("?", 1)[0].rstrip("/") or "/"
+                    status, body, extra_headers = await self._dispatch(method, path, body)
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                status, body, extra_headers = 400, {"error": f"malformed request: {str(e)}"}, {}
+            
+            data = json.dumps(body).encode()
+            head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", "Content-Type: application/json",
+                    f"Content-Length: {len(data)}", "Connection: close"]
+            head += [f"{name}: {value}" for name, value in extra_headers.items()]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self._connections.discard(asyncio.current_task())
+    
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._stopping = asyncio.Event()
+        await self._loop.run_in_executor(self._executor, self.warm_up)
+        
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass  # Not on the main thread (e.g. started from a notebook); use stop() instead
+        print(f"Serving on http://{self.host}:{self.port} "
+              f"(concurrency {self.concurrency}, queue {self.queue_size})")
+        self.ready.set()
+        
+        await self._stopping.wait()
+        print(f"Shutting down: draining {len(self._connections)} in-flight requests...")
+        server.close()
+        pending = set()
+        if self._connections:
+            _, pending = await asyncio.wait(set(self._connections), timeout=self.drain_timeout)
+        if pending:
+            print(f"{len(pending)} requests still running after {self.drain_timeout}s; abandoning them")
+        else:
+            await server.wait_closed()
+        self._executor.shutdown(wait=not pending, cancel_futures=True)
+        release_diffusion_pipelines()
+        print("Service stopped")
+    
+    def run(self):
+        asyncio.run(self.serve())
+    
+    def stop(self):
+        """Begin a graceful shutdown; safe to call from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+# Execute the pipeline
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate image variations from input images.")
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="run the pipeline over the sample images (default)")
+    run_parser.add_argument("--mode", choices=["txt2img", "img2img"], default="txt2img",
+                            help="img2img skips describe/rewrite and denoises from the input image")
+    run_parser.add_argument("--strength", type=float, default=IMG2IMG_STRENGTH, help="img2img strength (0-1)")
+    run_parser.add_argument("--draft-size", type=int, help="fast mode: denoise at this long side (e.g. 256) and upscale")
+    run_parser.add_argument("--refine-strength", type=float, default=0.0,
+                            help="img2img strength of a full-size refinement pass, e.g. after upscaling drafts (0 = none)")
+    corpus_parser = subparsers.add_parser("corpus", help="process a directory or glob of images, resuming previous runs")
+    corpus_parser.add_argument("source", help="directory (searched recursively) or glob of input images")
+    corpus_parser.add_argument("--state", default="corpus_state.sqlite", help="checkpoint database path")
+    corpus_parser.add_argument("--num-images", type=int, default=4, help="variations generated per input image")
+    corpus_parser.add_argument("--output-dir", default="generated_images/corpus", help="root directory for rendered images")
+    corpus_parser.add_argument("--chunk-size", type=int, default=8, help="images described and rewritten per batch")
+    bench_parser = subparsers.add_parser("bench", help="benchmark each stage with a stub model server and a tiny model")
+    bench_parser.add_argument("--images", help="glob of input images; random images are generated if omitted")
+    bench_parser.add_argument("--iterations", type=int, default=5, help="number of input images to process")
+    bench_parser.add_argument("--num-images", type=int, default=2, help="variations generated per input image")
+    bench_parser.add_argument("--latency", type=float, default=0.05, help="stub server latency per request, in seconds")
+    bench_parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub requests failing with 503")
+    bench_parser.add_argument("--output-dir", default="benchmarks", help="directory for JSON results")
+    bench_parser.add_argument("--baseline", help="earlier JSON result to compare against")
+    bench_parser.add_argument("--resolutions", help="comma-separated sizes; measure peak RSS vs resolution instead")
+    bench_parser.add_argument("--steps", type=int, default=20, help="denoising steps for the resolution sweep")
+    autotune_parser = subparsers.add_parser("autotune", help="find the fastest render settings for this machine")
+    autotune_parser.add_argument("--resolution", type=int, default=256, help="render size used for timing")
+    autotune_parser.add_argument("--steps", type=int, default=4, help="denoising steps per timed render")
+    autotune_parser.add_argument("--repeats", type=int, default=2, help="timed renders per configuration")
+    autotune_parser.add_argument("--profile", default=RENDER_PROFILE_PATH, help="where to write the render profile")
+    serve_parser = subparsers.add_parser("serve", help="serve the pipeline over HTTP with warm models")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="interface to listen on")
+    serve_parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    serve_parser.add_argument("--concurrency", type=int, default=SERVICE_CONCURRENCY, help="requests executed at once")
+    serve_parser.add_argument("--queue-size", type=int, default=SERVICE_QUEUE_SIZE, help="requests waiting before 503s")
+    # Inside a notebook kernel sys.argv belongs to the kernel, so fall back to the default command
+    args = parser.parse_args([] if "ipykernel" in sys.modules else sys.argv[1:])
+    
+    if args.command == "corpus":
+        run_corpus(args.source, args.state, args.num_images, args.output_dir, args.chunk_size)
+    elif args.command == "autotune":
+        autotune_render_settings(args.resolution, args.steps, args.repeats, args.profile)
+    elif args.command == "serve":
+        PipelineService(args.host, args.port, args.concurrency, args.queue_size).run()
+    elif args.command == "bench" and args.resolutions:
+        run_resolution_sweep([int(size) for size in args.resolutions.split(",")], args.steps, args.output_dir)
+    elif args.command == "bench":
+        run_benchmark(sorted(glob.glob(args.images)) if args.images else None, args.iterations, args.num_images,
+                      args.latency, args.error_rate, args.output_dir, args.baseline)
+    else:
+        try:
+            validate_render_options(512, 512, getattr(args, "draft_size", None), getattr(args, "refine_strength", 0.0))
+        except ValueError as e:
+            parser.error(str(e))
+        inputs = []
+        for img in ["imgs/agent-overview.png", "imgs/multimodal.png", "img-files/tree-frog.jpg", "img-files/paint-cat.jpg"]:
+            if os.path.exists(img):
+                inputs.append(img)
+            else:
+                print(f"Image {img} not found")
+        results = generate_images_from_images(inputs, mode=getattr(args, "mode", "txt2img"),
+                                              strength=getattr(args, "strength", IMG2IMG_STRENGTH),
+                                              draft_size=getattr(args, "draft_size", None),
+                                              refine_strength=getattr(args, "refine_strength", 0.0))
     
-    print("\nPipeline completed successfully!")
-    print(f"Processed {len(results)} images total")
-    for i, (image_paths, prompts, desc) in enumerate(results, 1):
-        print(f"Image {i}: Generated {len(image_paths)} variations")
-        print(f"File paths: {', '.join(image_paths)}")
+        print("\nPipeline completed successfully!")
+        print(f"Processed {len(results)} images total")
+        for i, (image_paths, prompts, desc) in enumerate(results, 1):
+            print(f"Image {i}: Generated {len(image_paths)} variations")
+            print(f"File paths: {', '.join(image_paths)}")